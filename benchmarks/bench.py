@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Benchmark the op1repacker stages on synthetic firmware.
+
+Every benchmark runs in a fresh process so that the peak memory (RSS) of one
+benchmark doesn't affect the others. Everything runs offline on firmware made
+by fake_firmware.py.
+
+Usage:
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --baseline results.json   # Compare against earlier results
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_firmware  # noqa: E402
+from op1repacker import op1_analyze, op1_db, op1_gfx, op1_patches, op1_repack  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'op1repacker')
+GFX_PATCHES = ['tape-invert', 'cwo-moose']
+DB_MEMBER = os.path.join('content', 'op1_factory.db')
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark. The function does any setup and returns (function to time, bytes processed)."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def copy_file(path, work):
+    target = os.path.join(work, os.path.basename(path))
+    shutil.copyfile(path, target)
+    return target
+
+
+def copy_tree(path, work):
+    target = os.path.join(work, os.path.basename(path))
+    shutil.copytree(path, target)
+    return target
+
+
+# OP1Repack stages
+
+@benchmark('repack.unpack')
+def bench_unpack(work, fixture):
+    path = copy_file(fixture['firmware'], work)
+    return lambda: op1_repack.OP1Repack().unpack(path), os.path.getsize(path)
+
+
+@benchmark('repack.repack')
+def bench_repack(work, fixture):
+    path = copy_tree(fixture['tree'], work)
+    return lambda: op1_repack.OP1Repack().repack(path), fixture['tar_size']
+
+
+@benchmark('repack.verify')
+def bench_verify(work, fixture):
+    return lambda: op1_repack.OP1Repack().verify(fixture['firmware']), os.path.getsize(fixture['firmware'])
+
+
+# OP1DB mods
+
+def db_benchmark(name, mod):
+    @benchmark('db.' + name)
+    def bench(work, fixture):
+        path = copy_file(os.path.join(fixture['tree'], DB_MEMBER), work)
+
+        def run():
+            db = op1_db.OP1DB()
+            db.open(path)
+            mod(db)
+            db.commit()
+            db.close()
+        return run, os.path.getsize(path)
+    return bench
+
+
+def insert_iter_presets(db):
+    patches = op1_patches.load_patch_folder(os.path.join(APP_PATH, 'assets', 'presets', 'iter'))
+    for patch in patches:
+        db.insert_synth_preset(json.dumps(patch), 'iter')
+
+
+db_benchmark('enable_iter', lambda db: db.enable_iter())
+db_benchmark('enable_filter', lambda db: db.enable_filter())
+db_benchmark('enable_subtle_fx_defaults', lambda db: db.enable_subtle_fx_defaults())
+db_benchmark('synth_preset_folder_exists', lambda db: db.synth_preset_folder_exists('iter'))
+db_benchmark('presets_iter', insert_iter_presets)
+
+
+# op1_gfx patches
+
+def gfx_benchmark(patch_name):
+    @benchmark('gfx.' + patch_name)
+    def bench(work, fixture):
+        with open(os.path.join(APP_PATH, 'assets', 'display', patch_name + '.patch.json')) as f:
+            patch = json.load(f)
+        with open(os.path.join(fixture['tree'], 'content', 'display', patch['file'])) as f:
+            data = f.read()
+        return lambda: op1_gfx.apply_patch(data, patch), len(data.encode('utf-8'))
+    return bench
+
+
+for gfx_patch in GFX_PATCHES:
+    gfx_benchmark(gfx_patch)
+
+
+# Analyze
+
+@benchmark('analyze.analyze_unpacked_fw')
+def bench_analyze(work, fixture):
+    return lambda: op1_analyze.analyze_unpacked_fw(fixture['tree']), fixture['tar_size']
+
+
+@benchmark('analyze.analyze_firmware_file')
+def bench_analyze_firmware_file(work, fixture):
+    repacker = op1_repack.OP1Repack()
+    return lambda: op1_analyze.analyze_firmware_file(fixture['firmware'], repacker), fixture['tar_size']
+
+
+def peak_rss():
+    """Return the peak resident set size of the current process in bytes, or None if it's unknown."""
+    # ru_maxrss is inherited over exec on Linux, the high water mark in /proc isn't
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_benchmark(name, fixture):
+    """Run a single benchmark and return its measurements. Meant to be run in a fresh process."""
+    work = tempfile.mkdtemp(prefix='op1bench-')
+    try:
+        func, size = BENCHMARKS[name](work, fixture)
+        # Keep the output of the measured code out of the results
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            wall_time = time.perf_counter() - start
+        return {
+            'wall_time': wall_time,
+            'bytes': size,
+            'throughput': size / wall_time if wall_time else None,
+            'peak_rss': peak_rss(),
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def run_isolated(func, *args):
+    """Run func in a fresh process."""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(func, *args).result()
+
+
+def create_fixture(path, size, presets, svgs):
+    """Create the synthetic firmware and measure the size of its TAR."""
+    tree = os.path.join(path, 'op1_bench')
+    firmware = fake_firmware.generate_firmware_file(tree, content_size=int(size * 1024 * 1024),
+                                                    preset_count=presets, svg_count=svgs)
+    tar = os.path.join(path, 'op1_bench.tar')
+    with tarfile.open(tar, 'w', format=tarfile.GNU_FORMAT) as archive:
+        op1_repack.OP1Repack().add_files_to_tar(archive, tree)
+    return {
+        'tree': tree,
+        'firmware': firmware,
+        'tar_size': os.path.getsize(tar),
+    }
+
+
+def run_benchmarks(names, fixture, repeat):
+    """Run each benchmark repeat times and keep the fastest run and the highest memory use."""
+    results = {}
+    for name in names:
+        runs = [run_isolated(run_benchmark, name, fixture) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run['wall_time'])
+        rss = [run['peak_rss'] for run in runs if run['peak_rss'] is not None]
+        best['peak_rss'] = max(rss) if rss else None
+        results[name] = best
+        print('{:<36} {:>9.4f}s {:>10} {:>10}'.format(
+            name, best['wall_time'], format_rate(best['throughput']), format_bytes(best['peak_rss'])))
+    return results
+
+
+def format_bytes(value):
+    if value is None:
+        return '-'
+    return '{:.1f}MB'.format(value / 1024 / 1024)
+
+
+def format_rate(value):
+    if value is None:
+        return '-'
+    return format_bytes(value) + '/s'
+
+
+def compare(results, baseline, time_threshold, memory_threshold, min_time):
+    """Return descriptions of the benchmarks that are slower or use more memory than the baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if not old:
+            continue
+        if result['wall_time'] > old['wall_time'] * (1 + time_threshold) and \
+                result['wall_time'] - old['wall_time'] > min_time:
+            regressions.append('{}: wall time {:.4f}s -> {:.4f}s'.format(name, old['wall_time'], result['wall_time']))
+        if result['peak_rss'] and old.get('peak_rss') and \
+                result['peak_rss'] > old['peak_rss'] * (1 + memory_threshold):
+            regressions.append('{}: peak memory {} -> {}'.format(
+                name, format_bytes(old['peak_rss']), format_bytes(result['peak_rss'])))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark op1repacker on synthetic firmware.')
+    parser.add_argument('benchmarks', nargs='*', help='names or name prefixes of the benchmarks to run (default: all)')
+    parser.add_argument('--size', type=float, default=8, help='size of the synthetic firmware content in megabytes')
+    parser.add_argument('--presets', type=int, default=500, help='number of synth presets in the database')
+    parser.add_argument('--svgs', type=int, default=20, help='number of extra display SVGs')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per benchmark, the fastest counts')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--time-threshold', type=float, default=0.2,
+                        help='allowed relative increase of wall time before it counts as a regression')
+    parser.add_argument('--memory-threshold', type=float, default=0.2,
+                        help='allowed relative increase of peak memory before it counts as a regression')
+    parser.add_argument('--min-time', type=float, default=0.005,
+                        help='wall time differences in seconds below this never count as a regression')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(sorted(BENCHMARKS)))
+        return 0
+
+    names = [name for name in sorted(BENCHMARKS)
+             if not args.benchmarks or any(name.startswith(prefix) for prefix in args.benchmarks)]
+    if not names:
+        print('No benchmarks match {}'.format(' '.join(args.benchmarks)))
+        return 1
+
+    path = tempfile.mkdtemp(prefix='op1bench-fixture-')
+    try:
+        print('Generating {}MB of synthetic firmware...'.format(args.size))
+        # Generate in another process to keep the memory use of this one low
+        fixture = run_isolated(create_fixture, path, args.size, args.presets, args.svgs)
+        print('{:<36} {:>10} {:>10} {:>10}'.format('BENCHMARK', 'TIME', 'RATE', 'PEAK RSS'))
+        results = run_benchmarks(names, fixture, args.repeat)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'config': {'size': args.size, 'presets': args.presets, 'svgs': args.svgs, 'repeat': args.repeat},
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.time_threshold, args.memory_threshold,
+                              args.min_time)
+        if regressions:
+            print('\nRegressions compared to {}:'.format(args.baseline))
+            for regression in regressions:
+                print('    ' + regression)
+            return 1
+        print('\nNo regressions compared to {}.'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
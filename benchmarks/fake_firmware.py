@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Generate synthetic OP-1 firmware for benchmarking without needing a real firmware file.
+
+The generated firmware has the parts that op1repacker works with: LDR images with
+version strings, an op1_factory.db with the fx_types, synth_types and synth_presets
+tables and display SVGs with the elements the included GFX patches change.
+"""
+
+import os
+import sys
+import json
+import random
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from op1repacker import op1_repack  # noqa: E402
+
+FX_TYPES = ['cwo', 'delay', 'grid', 'nitro', 'phone', 'punch', 'spring']
+SYNTH_TYPES = ['cluster', 'digital', 'dna', 'fm', 'phase', 'pulse', 'sampler', 'string', 'voltage']
+TAPE_ELEMENTS = [
+    ('line', 'centerline_23_'),
+    ('line', 'ghost_x5F_line'),
+    ('circle', 'loopin'),
+    ('circle', 'loopout'),
+    ('line', 'loop_x5F_line'),
+    ('line', 'track_x5F_active'),
+    ('line', 'track_x5F_semiactive_15_'),
+    ('line', 'track_x5F_inactive'),
+    ('line', '_x3C_Path_x3E__1_'),
+]
+
+
+def filler_data(rng, size, compressibility=0.5):
+    """Return size bytes where roughly the given fraction compresses well and the rest is random."""
+    compressible = int(size * compressibility)
+    pattern = bytes(rng.randrange(256) for _ in range(64))
+    data = pattern * (compressible // len(pattern) + 1)
+    return data[:compressible] + rng.randbytes(size - compressible)
+
+
+def write_ldr_files(path, rng, ldr_size):
+    main_ldr = (filler_data(rng, ldr_size // 2) + b'Rev. 00235; 2019/01/07 17:45:00 (built by bench)\n' +
+                b'R. 00235\x00' + filler_data(rng, ldr_size // 2))
+    with open(os.path.join(path, 'OP1_vdk.ldr'), 'wb') as f:
+        f.write(main_ldr)
+    boot_ldr = filler_data(rng, 16 * 1024) + b'TE-BOOT FW v2.18\x00' + filler_data(rng, 16 * 1024)
+    with open(os.path.join(path, 'te-boot.ldr'), 'wb') as f:
+        f.write(boot_ldr)
+
+
+def random_params(rng):
+    return json.dumps([rng.randrange(32768) for _ in range(8)])
+
+
+def write_database(path, rng, preset_count):
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE fx_types (id INTEGER PRIMARY KEY, type TEXT, default_params TEXT)')
+    db.execute('CREATE TABLE synth_types (id INTEGER PRIMARY KEY, type TEXT, default_params TEXT)')
+    db.execute('CREATE TABLE synth_presets (id INTEGER PRIMARY KEY, patch TEXT, folder TEXT)')
+    db.executemany('INSERT INTO fx_types VALUES (?, ?, ?)',
+                   [(i + 3, fx_type, random_params(rng)) for i, fx_type in enumerate(FX_TYPES)])
+    db.executemany('INSERT INTO synth_types VALUES (?, ?, ?)',
+                   [(i, synth_type, random_params(rng)) for i, synth_type in enumerate(SYNTH_TYPES)])
+    presets = []
+    for i in range(preset_count):
+        synth_type = rng.choice(SYNTH_TYPES)
+        patch = {
+            'type': synth_type,
+            'name': 'preset {}'.format(i),
+            'knobs': [rng.randrange(32768) for _ in range(8)],
+            'fx_params': [rng.randrange(32768) for _ in range(8)],
+            'lfo_params': [rng.randrange(32768) for _ in range(8)],
+        }
+        presets.append((json.dumps(patch), synth_type))
+    db.executemany('INSERT INTO synth_presets (patch, folder) VALUES (?, ?)', presets)
+    db.commit()
+    db.close()
+
+
+def svg_rows(rng, count):
+    """Return generic SVG elements of every kind the GFX code moves."""
+    rows = []
+    for i in range(count):
+        x, y = rng.randrange(320), rng.randrange(160)
+        # Decimal coordinates keep the values unique within the element like in the real SVGs
+        rows.append('\t<rect x="{}.25" y="{}.75" width="10" height="10" fill="#FFF"/>'.format(x, y))
+        rows.append('\t<line fill="none" stroke="#FFF" x1="{}" y1="{}" x2="{}" y2="{}"/>'.format(x, y, x + 5, y + 5))
+        rows.append('\t<circle fill="#FFF" cx="{}.5" cy="{}" r="2"/>'.format(x, y))
+        rows.append('\t<polyline fill="none" points="{},{} {},{} {},{}"/>'.format(x, y, x + 1, y + 2, x + 3, y + 4))
+        rows.append('\t<path fill="none" d="M{},{} C{},{} {},{} {},{} L{},{}"/>'.format(
+            x, y, x + 1, y + 1, x + 2, y + 3, x + 4, y + 4, x + 6, y))
+    return rows
+
+
+def tape_svg(rng, rows):
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<svg version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg" x="0px" y="0px"'
+             ' width="320px" height="160px" viewBox="0 0 320 160">']
+    lines.append('\t<g id="grid">')
+    lines.extend('\t' + row for row in svg_rows(rng, 4))
+    lines.append('\t</g>')
+    for tag, svg_id in TAPE_ELEMENTS:
+        if tag == 'circle':
+            lines.append('\t<circle id="{}" fill="#FFF" cx="{}" cy="150" r="3"/>'.format(svg_id, rng.randrange(320)))
+        else:
+            lines.append('\t<line id="{}" fill="none" stroke="#FFF" x1="1" y1="{}" x2="319" y2="{}"/>'.format(
+                svg_id, 140 + len(lines), 140 + len(lines)))
+    lines.extend(svg_rows(rng, rows))
+    lines.append('</svg>')
+    return '\n'.join(lines) + '\n'
+
+
+def bode_svg(rng, rows):
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<svg version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg" width="320px" height="160px">',
+             '\t<path fill="#FFF" d="M91.087,37.5 c0.5,0.5 -0.898-0.627"/>',
+             '\t<g id="cwo">',
+             '\t\t<path fill="none" stroke="#FFF" d="M10,10 L20,20"/>',
+             '\t</g>']
+    lines.extend(svg_rows(rng, rows))
+    lines.append('</svg>')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_firmware(path, content_size=8 * 1024 * 1024, ldr_size=2 * 1024 * 1024, svg_count=20,
+                      svg_rows_count=200, preset_count=500, seed=0):
+    """Create an unpacked synthetic firmware directory at path."""
+    rng = random.Random(seed)
+    display_path = os.path.join(path, 'content', 'display')
+    os.makedirs(display_path)
+
+    write_ldr_files(path, rng, ldr_size)
+    write_database(os.path.join(path, 'content', 'op1_factory.db'), rng, preset_count)
+
+    with open(os.path.join(display_path, 'tape.svg'), 'w') as f:
+        f.write(tape_svg(rng, svg_rows_count))
+    with open(os.path.join(display_path, 'bode.svg'), 'w') as f:
+        f.write(bode_svg(rng, svg_rows_count))
+    with open(os.path.join(display_path, 'iter.svg'), 'w') as f:
+        f.write(bode_svg(rng, svg_rows_count // 4))
+    for i in range(svg_count):
+        with open(os.path.join(display_path, 'extra_{}.svg'.format(i)), 'w') as f:
+            f.write(bode_svg(rng, svg_rows_count // 4))
+
+    # Fill the rest of the content with sample like data spread over a few folders
+    file_size = 256 * 1024
+    for i in range(max(content_size // file_size, 1)):
+        folder = os.path.join(path, 'content', 'samples', 'bank_{}'.format(i % 8))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'sample_{}.bin'.format(i)), 'wb') as f:
+            f.write(filler_data(rng, file_size, compressibility=0.7))
+    return path
+
+
+def generate_firmware_file(path, **kwargs):
+    """Create a synthetic firmware directory at path and pack it into path.op1."""
+    generate_firmware(path, **kwargs)
+    repacker = op1_repack.OP1Repack()
+    repacker.compress_stream(path, path + '.op1')
+    return path + '.op1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic OP-1 firmware for benchmarking.')
+    parser.add_argument('path', help='directory to create, the packed firmware is saved as path.op1')
+    parser.add_argument('--size', type=float, default=8, help='size of the filler content in megabytes')
+    parser.add_argument('--presets', type=int, default=500, help='number of synth presets in the database')
+    parser.add_argument('--svgs', type=int, default=20, help='number of extra display SVGs')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        print('The path "{}" already exists!'.format(args.path))
+        return 1
+    firmware = generate_firmware_file(args.path, content_size=int(args.size * 1024 * 1024),
+                                      preset_count=args.presets, svg_count=args.svgs, seed=args.seed)
+    print('Created {} and {}'.format(args.path, firmware))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
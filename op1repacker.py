@@ -3,7 +3,9 @@
 
 """Convenience wrapper for running op1repacker directly from source tree."""
 
+import sys
+
 from op1repacker.main import main
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,16 +1,14 @@
 #!/usr/bin/env python3
 """Unpack and repack OP1 firmware in order to create custom firmware."""
 
+import io
 import os
+import sys
 import json
 import argparse
-from shutil import copyfile
+from contextlib import redirect_stdout
 
-from . import op1_analyze
-from . import op1_db
-from . import op1_gfx
-from . import op1_patches
-from . import op1_repack
+# The op1 modules are imported by the functions that need them, so each run only imports what its action needs
 
 
 __author__ = 'Richard Lewis'
@@ -30,161 +28,690 @@ may brick your OP-1.
 actions_help = """action to perform on the firmware
 - unpack: unpack a firmware file
 - repack: repackage unpacked firmware
-- modify: modify unpacked firmware with changes specified by --options
-- analyze: analyze version info and other things of an unpacked firmware directory
+- modify: modify unpacked firmware with changes specified by --options, --presets and --preset-pack
+- workspace: create a copy of unpacked firmware to modify that shares the unchanged files with the original
+- patch: modify a firmware file with changes specified by --options, --presets and --preset-pack without
+  unpacking it
+- analyze: analyze version info and other things of a firmware file or an unpacked firmware directory
+- ls: list the files in a firmware file
+- extract: extract the files specified by --member from a firmware file
+- export-presets: save the presets of a firmware file, unpacked firmware or op1_factory.db as .aif files
+- presets-index: add the .aif presets in the given folders to the preset library index
+- presets-search: list the presets in the preset library index that match --presets
+- tune: find the fastest LZMA settings for repacking that keep the firmware within the OP-1 limits
+- verify: verify the checksums of firmware files or directories containing them
+- diff: compare the files of two firmware files or unpacked firmware directories
+- serve: run a local build service that builds modified firmware from base firmware files
 
 """
 
 options_help = """changes to make on the unpacked firmware to enable mods and hidden features
 valid values are:
-- iter
-- presets-iter
-- filter
-- subtle-fx
-- gfx-iter-lab
-- gfx-cwo-moose
-- gfx-tape-invert
+{}
+and the mods added by installed plugins
 """
 
 
+def find_firmware_files(paths):
+    """Return the given firmware file paths with directories expanded to the firmware files they contain."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.op1'))
+    return files
+
+
+def verify_firmware(path):
+    """Verify the checksum of a firmware file and return a (passed, checksum, message) tuple."""
+    from . import op1_repack
+    repacker = op1_repack.OP1Repack()
+    try:
+        checksum, calced_crc = repacker.check_crc(path)
+    except (OSError, EOFError) as e:
+        return False, None, str(e)
+    if checksum != calced_crc:
+        return False, checksum, 'checksum mismatch, calculated 0x{:08x}'.format(calced_crc)
+    return True, checksum, ''
+
+
+def verify(paths, jobs=None):
+    """Verify firmware files in parallel and print the results as a table."""
+    files = find_firmware_files(paths)
+    if not files:
+        print('No firmware files found!')
+        return 1
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        results = list(executor.map(verify_firmware, files, chunksize=8))
+
+    width = max(len(path) for path in files)
+    print('{:<6}  {:<10}  {:<{width}}  {}'.format('STATUS', 'CRC-32', 'PATH', 'ERROR', width=width))
+    for path, (passed, checksum, message) in zip(files, results):
+        status = 'OK' if passed else 'FAIL'
+        checksum = '-' if checksum is None else '0x{:08x}'.format(checksum)
+        print('{:<6}  {:<10}  {:<{width}}  {}'.format(status, checksum, path, message, width=width).rstrip())
+
+    passed_count = sum(1 for passed, _, _ in results if passed)
+    print('\n{} of {} firmware files passed.'.format(passed_count, len(files)))
+    return 0 if passed_count == len(files) else 1
+
+
+def format_size(size):
+    return '{:,} bytes'.format(size)
+
+
+def diff_targets(args):
+    """Compare two firmware files or directories and print the added, removed and changed files."""
+    from . import op1_manifest
+    if len(args.path) != 2:
+        print('Please specify exactly two firmware files or directories to compare.')
+        return 1
+    old_path, new_path = args.path
+    for path in args.path:
+        if not os.path.exists(path):
+            print('The specified path "{}" doesn\'t exist!'.format(path))
+            return 1
+
+    print('Comparing {} to {}...'.format(old_path, new_path))
+    added, removed, changed = op1_manifest.diff(old_path, new_path, jobs=args.jobs or None)
+    for name in added:
+        print('    + {}'.format(name))
+    for name in removed:
+        print('    - {}'.format(name))
+    for name, old_info, new_info in changed:
+        details = []
+        if old_info['sha256'] != new_info['sha256']:
+            details.append('{} -> {}'.format(format_size(old_info['size']), format_size(new_info['size'])))
+        if old_info['mode'] != new_info['mode']:
+            details.append('mode {:o} -> {:o}'.format(old_info['mode'], new_info['mode']))
+        print('    M {} ({})'.format(name, ', '.join(details)))
+    print('{} added, {} removed, {} changed.'.format(len(added), len(removed), len(changed)))
+    return 0
+
+
+def analyze_firmware(path):
+    """Analyze a firmware file or directory and return (data, error message)."""
+    from . import op1_analyze
+    from . import op1_repack
+    try:
+        return op1_analyze.analyze(path, op1_repack.OP1Repack()), None
+    except op1_repack.FIRMWARE_ERRORS + (OSError, ValueError) as e:
+        return None, str(e) or e.__class__.__name__
+
+
+def analyze_paths(args, catalog=None):
+    """Analyze the target paths in parallel, using and updating the catalog if one is given.
+
+    Returns the results in the order the paths were given and the number of paths that couldn't be analyzed.
+    """
+    from . import op1_catalog
+    from . import op1_repack
+    repacker = op1_repack.OP1Repack(debug=args.debug)
+    results = {}
+    signatures = {}
+    pending = []
+    failed = 0
+    for path in args.path:
+        if not os.path.exists(path):
+            print('The specified path "{}" doesn\'t exist!'.format(path), file=sys.stderr)
+            failed += 1
+            continue
+        if catalog is not None:
+            try:
+                signatures[path] = op1_catalog.signature(path, repacker)
+            except (OSError, EOFError) as e:
+                print('Failed to analyze {}: {}'.format(path, e), file=sys.stderr)
+                failed += 1
+                continue
+            results[path] = catalog.get(path, signatures[path])
+            if results[path] is not None:
+                continue
+        pending.append(path)
+
+    if len(pending) > 1 and args.jobs != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+            analyzed = list(executor.map(analyze_firmware, pending))
+    else:
+        analyzed = [analyze_firmware(path) for path in pending]
+
+    for path, (data, error) in zip(pending, analyzed):
+        if error is not None:
+            print('Failed to analyze {}: {}'.format(path, error), file=sys.stderr)
+            failed += 1
+            results[path] = None
+        elif catalog is not None:
+            results[path] = catalog.put(path, signatures[path], data)
+        else:
+            results[path] = {'path': os.path.abspath(path), **data}
+
+    records = [results[path] for path in args.path if results.get(path) is not None]
+    return records, failed
+
+
+def print_analysis(records, output_format):
+    if output_format == 'json':
+        print(json.dumps(records, indent=4))
+        return
+    for record in records:
+        if output_format == 'ndjson':
+            print(json.dumps(record))
+            continue
+        print('{}:'.format(record['path']))
+        for key, value in record.items():
+            if key != 'path':
+                label = key.upper().replace('_', ' ')
+                print('    - ' + label + ': ' + str(value))
+        print('')
+
+
+def analyze_targets(args):
+    """Analyze firmware files and directories or query the catalog and print the results."""
+    from . import op1_catalog
+    filters = {
+        'firmware_version': args.firmware_version,
+        'build_date': args.build_date,
+        'bootloader_version': args.bootloader_version,
+    }
+    if not args.path and not args.catalog:
+        print('Please specify firmware files or directories to analyze, or a catalog to query with --catalog.')
+        return 1
+
+    catalog = op1_catalog.FirmwareCatalog(args.catalog) if args.catalog else None
+    try:
+        if args.path:
+            records, failed = analyze_paths(args, catalog)
+            records = [record for record in records if op1_catalog.matches(record, **filters)]
+        else:
+            records, failed = catalog.query(**filters), 0
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+    print_analysis(records, args.format)
+    return 1 if failed else 0
+
+
+def index_presets(args):
+    """Scan the given folders for presets and update the preset library index."""
+    from . import op1_patches
+    from . import op1_presets
+    index = op1_presets.PresetIndex(args.preset_index or op1_presets.DEFAULT_INDEX_PATH)
+    try:
+        for path in args.path:
+            if not os.path.isdir(path):
+                print('The path to index must be a directory: {}'.format(path))
+                return 1
+            print('Indexing presets in {}...'.format(path))
+            updated, removed = index.scan(path, threads=args.threads or op1_patches.LOAD_THREADS)
+            print('    {} presets added or updated, {} removed.'.format(updated, removed))
+    finally:
+        index.close()
+    return 0
+
+
+def query_presets(args):
+    """Return the presets in the preset library index that match the --presets query."""
+    from . import op1_presets
+    index = op1_presets.PresetIndex(args.preset_index or op1_presets.DEFAULT_INDEX_PATH)
+    try:
+        return index.query(op1_presets.parse_query(args.presets))
+    finally:
+        index.close()
+
+
+def load_preset_packs(paths):
+    """Load the presets of preset packs, which can be folders or ZIP or TAR archives of .aif files.
+
+    Raises ValueError if a pack has no presets.
+    """
+    from . import op1_patches
+    presets = []
+    for path in paths:
+        patches = op1_patches.load_patches(path)
+        if not patches:
+            raise ValueError('No presets found in {}'.format(path))
+        print('Loaded {} presets from {}.'.format(len(patches), path))
+        presets.extend(patches)
+    return presets
+
+
+def search_presets(args):
+    if not args.presets:
+        print('Please specify the presets to search for with --presets argument, e.g. --presets "type=iter tag=bass".')
+        return 1
+    try:
+        results = query_presets(args)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    if args.format == 'text':
+        for result in results:
+            print('{:<10}  {}'.format(result['type'] or '-', result['path']))
+        print('{} presets found.'.format(len(results)))
+    elif args.format == 'json':
+        print(json.dumps(results, indent=4))
+    else:
+        for result in results:
+            print(json.dumps(result))
+    return 0
+
+
+def create_repacker(args):
+    from . import op1_repack
+    from . import op1_tune
+    repacker = op1_repack.OP1Repack(debug=args.debug)
+    if args.profile:
+        repacker.lzma_filters = op1_tune.load_profile(args.profile)
+    return repacker
+
+
+def tune_target(target_path, args):
+    from . import op1_repack
+    from . import op1_tune
+    if not os.path.isdir(target_path):
+        print('The path to tune must be a directory!')
+        return False
+
+    repacker = op1_repack.OP1Repack(debug=args.debug)
+    print('Trying LZMA settings on {}...'.format(target_path))
+    results = op1_tune.tune(target_path, repacker, jobs=args.jobs or None)
+
+    print('    {:>6}  {:>3}  {:>4}  {:>5}  {:>2}  {:>2}  {:>2}  {:>9}  {:>10}  {:>9}  {:>10}  {}'.format(
+        'MODE', 'MF', 'NICE', 'DEPTH', 'LC', 'LP', 'PB', 'DICT', 'SIZE', 'TIME', 'MEMORY', 'OK'))
+    for result in results:
+        settings = result['settings']
+        print('    {:>6}  {:>3}  {:>4}  {:>5}  {:>2}  {:>2}  {:>2}  {:>9}  {:>10}  {:>7.2f}s{}  {:>10}  {}'.format(
+            settings['mode'], settings['mf'], settings['nice_len'], settings['depth'], settings['lc'],
+            settings['lp'], settings['pb'], settings['dict_size'], result['compressed_size'],
+            result['compression_time'], '*' if result['timed_alone'] else ' ', result['decoder_memory'],
+            'yes' if result['ok'] else 'no'))
+    print('    * timed alone, the other times were measured in parallel and only give a rough idea')
+
+    best = op1_tune.best_result(results)
+    if best is None:
+        print('None of the settings keep the firmware within the limits of the OP-1!')
+        return False
+    profile_path = args.profile or op1_tune.profile_path(target_path)
+    op1_tune.save_profile(profile_path, best)
+    print('Saved the fastest settings within the limits to {}'.format(profile_path))
+    print('Use them with: repack --profile {}'.format(profile_path))
+    return True
+
+
+def repack_target(target_path, args):
+    from . import op1_cache
+    if not os.path.isdir(target_path):
+        print('The path to repack must be a directory!')
+        return False
+
+    repacker = create_repacker(args)
+    cache = None
+    if not args.no_cache:
+        cache_size = op1_cache.DEFAULT_MAX_SIZE if args.cache_size is None else args.cache_size * 1024 * 1024
+        cache = op1_cache.RepackCache(max_size=cache_size)
+    print('Repacking {}...'.format(target_path))
+    if repacker.repack(target_path, cache=cache):
+        print('Done!')
+        return True
+    print('Errors occured during repacking!')
+    return False
+
+
+def unpack_target(target_path, args):
+    from . import op1_repack
+    if not os.path.isfile(target_path):
+        print('The path to unpack must be a file!')
+        return False
+
+    if not target_path.endswith('.op1'):
+        print('That doesn\'t seem to be a firmware file. The extension must be ".op1".')
+
+    repacker = op1_repack.OP1Repack(debug=args.debug)
+    print('Unpacking {}...'.format(target_path))
+    if repacker.unpack(target_path, threads=args.threads):
+        print('Done!')
+        return True
+    print('Errors occured during unpacking!')
+    return False
+
+
+def workspace_target(target_path, args):
+    from . import op1_workspace
+    if not os.path.isdir(target_path):
+        print('The path to create a workspace of must be a directory!')
+        return False
+
+    workspace_path = args.output or os.path.normpath(target_path) + op1_workspace.WORKSPACE_SUFFIX
+    if os.path.exists(workspace_path):
+        print('The workspace "{}" already exists!'.format(workspace_path))
+        return False
+    print('Creating workspace {}...'.format(workspace_path))
+    op1_workspace.create_workspace(target_path, workspace_path)
+    print('Done!')
+    return True
+
+
+def modify_target(target_path, args):
+    from . import op1_mods
+    if not os.path.isdir(target_path):
+        print('The path to modify must be a directory!')
+        return False
+
+    success = op1_mods.modify(target_path, args.options or [], args.preset_data, dry_run=args.dry_run)
+    print('')
+    print('Done.')
+    return success
+
+
+def patch_target(target_path, args):
+    from . import op1_mods
+    if not os.path.isfile(target_path):
+        print('The path to patch must be a firmware file!')
+        return False
+
+    repacker = create_repacker(args)
+    print('Patching {}...'.format(target_path))
+    if repacker.patch(target_path, op1_mods.member_changes(args.options or [], args.preset_data)):
+        print('Done!')
+        return True
+    print('Errors occured during patching!')
+    return False
+
+
+def ls_target(target_path, args):
+    from . import op1_index
+    from . import op1_repack
+    if not os.path.isfile(target_path):
+        print('The path to list must be a firmware file!')
+        return False
+
+    repacker = op1_repack.OP1Repack(debug=args.debug)
+    try:
+        members = op1_index.list_members(target_path, repacker)
+    except op1_repack.FIRMWARE_ERRORS as e:
+        print('Failed to read firmware file {}: {}'.format(target_path, e))
+        return False
+    print('{}:'.format(target_path))
+    for member in members:
+        name = member['name'] + '/' if member['type'] == 'dir' else member['name']
+        print('    {:>10}  {}'.format(member['size'], name))
+    return True
+
+
+def extract_target(target_path, args):
+    from . import op1_index
+    from . import op1_repack
+    if not os.path.isfile(target_path):
+        print('The path to extract from must be a firmware file!')
+        return False
+
+    # Extract to the same folder the firmware would be unpacked to by default
+    output = args.output or os.path.splitext(os.path.abspath(target_path))[0]
+    repacker = op1_repack.OP1Repack(debug=args.debug)
+    if output != '-':
+        print('Extracting from {} to {}...'.format(target_path, output))
+    try:
+        missing = op1_index.extract_members(target_path, args.member, output, repacker)
+    except op1_repack.FIRMWARE_ERRORS as e:
+        print('Failed to read firmware file {}: {}'.format(target_path, e))
+        return False
+    for name in missing:
+        print('Member "{}" not found in {}!'.format(name, target_path))
+    if missing:
+        return False
+    if output != '-':
+        print('Done!')
+    return True
+
+
+def export_presets_target(target_path, args):
+    import tempfile
+    from . import op1_db
+    from . import op1_index
+    from . import op1_mods
+    from . import op1_patches
+    from . import op1_repack
+    # Save the presets next to the firmware by default, e.g. op1_235-presets/
+    output = args.output or os.path.splitext(os.path.abspath(target_path))[0] + '-presets'
+    threads = args.threads or op1_patches.EXPORT_THREADS
+    print('Exporting presets from {} to {}...'.format(target_path, output))
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        if os.path.isdir(target_path):
+            db_path = os.path.join(target_path, *op1_mods.DB_MEMBER.split('/'))
+        elif target_path.endswith('.db'):
+            db_path = target_path
+        else:
+            # Only the database is decompressed from the firmware file
+            repacker = op1_repack.OP1Repack(debug=args.debug)
+            if op1_index.extract_members(target_path, [op1_mods.DB_MEMBER], temp_path, repacker):
+                print('The firmware file doesn\'t contain {}!'.format(op1_mods.DB_MEMBER))
+                return False
+            db_path = os.path.join(temp_path, *op1_mods.DB_MEMBER.split('/'))
+
+        db = op1_db.OP1DB()
+        db.open(db_path)
+        try:
+            count = op1_patches.export_presets(db, output, threads)
+        finally:
+            db.close()
+    print('Exported {} presets.'.format(count))
+    return True
+
+
+target_actions = {
+    'repack': repack_target,
+    'unpack': unpack_target,
+    'modify': modify_target,
+    'workspace': workspace_target,
+    'patch': patch_target,
+    'ls': ls_target,
+    'extract': extract_target,
+    'tune': tune_target,
+    'export-presets': export_presets_target,
+}
+
+
+def run_target(target_path, args):
+    """Run the selected action on a single target path and return True on success."""
+    if not os.path.exists(target_path):
+        print('The specified path "{}" doesn\'t exist!'.format(target_path))
+        return False
+    try:
+        return target_actions[args.action](target_path, args)
+    except Exception:
+        import traceback
+        # Report the error but let the other targets be processed
+        traceback.print_exc(file=sys.stdout)
+        return False
+
+
+def run_target_recorded(target_path, args):
+    """Run the selected action on a target and return (success, stages). Stages are only recorded with --stats."""
+    from . import op1_stats
+    if not args.stats:
+        return run_target(target_path, args), []
+    recorder = op1_stats.StatsRecorder()
+    with op1_stats.recording(recorder):
+        success = run_target(target_path, args)
+    return success, recorder.stages
+
+
+def run_target_captured(target_path, args):
+    """Run the selected action on a target and return (success, stages, output) so it can be printed later."""
+    output = io.StringIO()
+    with redirect_stdout(output):
+        success, stages = run_target_recorded(target_path, args)
+    return success, stages, output.getvalue()
+
+
+def save_stats(path, target_paths, results):
+    targets = []
+    for target_path, (success, stages) in zip(target_paths, results):
+        targets.append({'path': target_path, 'success': success, 'stages': stages})
+    with open(path, 'w') as f:
+        json.dump({'targets': targets}, f, indent=4)
+
+
+def run_targets(args):
+    """Run the selected action on every target path and return the number of failed targets."""
+    jobs = 1 if args.jobs is None else args.jobs or os.cpu_count() or 1
+    if jobs == 1 or len(args.path) == 1:
+        results = [run_target_recorded(target_path, args) for target_path in args.path]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        results = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # Results are yielded in input order so the output of each target is printed in one piece
+            for success, stages, output in executor.map(run_target_captured, args.path, [args] * len(args.path)):
+                print(output, end='')
+                results.append((success, stages))
+
+    if args.stats:
+        save_stats(args.stats, args.path, results)
+        print('Saved stage statistics to {}'.format(args.stats))
+
+    failed = [success for success, _ in results].count(False)
+    if len(results) > 1:
+        print('{} of {} targets completed successfully.'.format(len(results) - failed, len(results)))
+    return failed
+
+
+def serve(args):
+    from . import op1_service
+    try:
+        op1_service.serve(args.socket, args.port, workers=args.jobs or None)
+    except (OSError, ValueError) as e:
+        print('Failed to start the build service: {}'.format(e))
+        return 1
+    return 0
+
+
 def main():
+    from . import op1_mods
+    mod_names = list(op1_mods.get_mods(plugins=False))
     parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('action', choices=['unpack', 'modify', 'repack', 'analyze'],
-                        help=actions_help)
-    parser.add_argument('path', type=str, nargs='+', help='firmware file or directory path')
-    parser.add_argument('--options', nargs='+', help=options_help)
+    parser.add_argument('action', help=actions_help, choices=[
+        'unpack', 'modify', 'workspace', 'patch', 'repack', 'analyze', 'ls', 'extract', 'export-presets',
+        'presets-index', 'presets-search', 'tune', 'verify', 'diff', 'serve'])
+    parser.add_argument('path', type=str, nargs='*', help='firmware file or directory path')
+    parser.add_argument('--options', nargs='+', help=options_help.format('\n'.join('- ' + name for name in mod_names)))
+    parser.add_argument('--presets', metavar='QUERY',
+                        help='presets to search for or add to the firmware from the preset library index, e.g.\n'
+                             '"type=iter tag=bass" or "type=drum adsr[0]>=1000", tags are the folder names\n'
+                             'the presets are in and name matches wildcards like "wood*"')
+    parser.add_argument('--preset-pack', metavar='PATH', nargs='+',
+                        help='folders or ZIP or TAR archives of .aif presets to add to the firmware, each preset\n'
+                             'is added to the folder of its synth type')
+    parser.add_argument('--preset-index', metavar='DB',
+                        help='preset library index file (default: ~/.cache/op1repacker/presets.db)')
+    parser.add_argument('--member', nargs='+', help='names of the files to extract, e.g. content/op1_factory.db')
+    parser.add_argument('--output', '-o', help='directory to extract or export to or to create the workspace at, "-"\n'
+                                               'writes extracted file contents to stdout')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='number of targets to process in parallel, 0 uses all CPU cores (default: 1)\n'
+                             'analyze, verify, diff and tune use all CPU cores by default, serve runs this many\n'
+                             'builds at once')
+    parser.add_argument('--threads', type=int,
+                        help='number of threads to write unpacked files or exported presets with (default: 1 for\n'
+                             'unpack, 4 for export-presets), more threads help with many small files on slow\n'
+                             'or network storage')
+    parser.add_argument('--profile', help='LZMA profile saved by tune to use when repacking, or the path to save it to')
+    parser.add_argument('--no-cache', action='store_true', help='don\'t use or update the cache of repacked firmware')
+    parser.add_argument('--cache-size', type=int, help='maximum size of the repack cache in megabytes (default: 1024)')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='save the time and data sizes of each processing stage and the peak memory use of '
+                             'the process so far as JSON')
+    parser.add_argument('--catalog', metavar='DB',
+                        help='catalog file to save analysis results to and reuse them from until the firmware\n'
+                             'changes, analyze without paths to query the catalog')
+    parser.add_argument('--firmware-version', help='only show results of this firmware version, e.g. "R. 00235"')
+    parser.add_argument('--build-date', help='only show results with a build date starting with this, e.g. 2019/01')
+    parser.add_argument('--bootloader-version', help='only show results of this bootloader version')
+    parser.add_argument('--format', choices=['text', 'json', 'ndjson'], default='text',
+                        help='output format of analyze and presets-search (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='show the changes modify would make and the size changes of the patched files\n'
+                             'without writing anything')
+    parser.add_argument('--socket', metavar='PATH', help='Unix socket to serve builds on instead of a port')
+    parser.add_argument('--port', type=int, default=8901,
+                        help='localhost port to serve builds on (default: %(default)s)')
     parser.add_argument('--debug', action='store_true', help='print debug messages')
     parser.add_argument('--version', '-v', action='version', version=__version__,
                         help='show program\'s version number and exit')
     args = parser.parse_args()
 
-    repacker = op1_repack.OP1Repack(debug=args.debug)
-
-    # Path to the app location (NOT the firmware path)
-    app_path = os.path.dirname(os.path.realpath(__file__))
-    db_actions = ['iter', 'filter', 'subtle-fx', 'presets-iter']
-
-    for target_path in args.path:
-        if not os.path.exists(target_path):
-            print('The specified path "{}" doesn\'t exist!'.format(target_path))
-            return
-
-        # Analyze
-        if args.action == 'analyze':
-            if not os.path.isdir(target_path):
-                print('The path to analyze must be a directory! Unpack the firmware file first.')
-                return
-            print('Analyzing {}...'.format(target_path))
-            data = op1_analyze.analyze_unpacked_fw(target_path)
-            for key, value in data.items():
-                label = key.upper().replace('_', ' ')
-                print('    - ' + label + ': ' + value)
-            print("Done.\n")
-
-        # Repack
-        if args.action == 'repack':
-            if not os.path.isdir(target_path):
-                print('The path to repack must be a directory!')
-                return
-
-            print('Repacking {}...'.format(target_path))
-            if repacker.repack(target_path):
-                print('Done!')
-            else:
-                print('Errors occured during repacking!')
-
-        # Unpack
-        elif args.action == 'unpack':
-            if not os.path.isfile(target_path):
-                print('The path to unpack must be a file!')
-                return
-
-            if not target_path.endswith('.op1'):
-                print('That doesn\'t seem to be a firmware file. The extension must be ".op1".')
-
-            print('Unpacking {}...'.format(target_path))
-            if repacker.unpack(target_path):
-                print('Done!')
-            else:
-                print('Errors occured during unpacking!')
-
-        # Modify
-        elif args.action == 'modify':
-            if not os.path.isdir(target_path):
-                print('The path to modify must be a directory!')
-                return
-
-            if not args.options:
-                print('Please specify what modifications to make with --options argument.')
-                return
-
-            # Only open the database for changes if at least one DB mod is selected
-            if set(db_actions) - (set(db_actions) - set(args.options)):
-                db_path = os.path.abspath(os.path.join(target_path, 'content', 'op1_factory.db'))
-                db = op1_db.OP1DB()
-                db.open(db_path)
-
-                print("Running database modifications:")
-
-                if 'iter' in args.options:
-                    print('- Enabling "iter" synth...')
-                    if not db.enable_iter():
-                        print('    Failed to enable "iter". Maybe it\'s already enabled?')
-
-                if 'presets-iter' in args.options:
-                    print('- Adding community presets for iter:')
-                    if not db.synth_preset_folder_exists('iter'):
-                        iter_preset_path = os.path.join(app_path, 'assets', 'presets', 'iter')
-                        patches = op1_patches.load_patch_folder(iter_preset_path)
-
-                        for patch in patches:
-                            print('    - ' + patch['name'])
-                            patch_data = json.dumps(patch)
-                            db.insert_synth_preset(patch_data, 'iter')
-                    else:
-                        print('    Iter already has presets, not adding new ones.')
-
-                if 'filter' in args.options:
-                    print('- Enabling "filter" effect...')
-                    if not db.enable_filter():
-                        print('    Failed to enable "filter". Maybe it\'s already enabled?')
-
-                if 'subtle-fx' in args.options:
-                    print('- Modifying FX defaults to be less intensive...')
-                    if not db.enable_subtle_fx_defaults():
-                        print('    Failed to modify default parameters for effects!')
-
-                # Commit changes to sqlite file
-                if not db.commit():
-                    print('Errors occured while modifying database!')
-
-                print('')
-
-            # Custom GFX
-            gfx_mods = filter(lambda opt: opt.startswith('gfx-'), args.options)
-            if gfx_mods:
-                print("Running graphics modifications:")
-            for mod in gfx_mods:
-                if mod == 'gfx-iter-lab':
-                    print('- Enabling custom lab graphic for iter...')
-                    path_from = os.path.join(app_path, 'assets', 'display', 'iter-lab.svg')
-                    path_to = os.path.abspath(os.path.join(target_path, 'content', 'display', 'iter.svg'))
-                    copyfile(path_from, path_to)
-                else:
-                    patch_name = mod[4:]
-                    patch_path = os.path.join(app_path, 'assets', 'display', patch_name + '.patch.json')
-                    if not os.path.exists(patch_path):
-                        print('    GFX patch "{}" doesn\'t exist!'.format(patch_name))
-                        continue
-
-                    print('- Applying GFX patch "{}"...'.format(patch_name))
-                    result = op1_gfx.patch_image_file(target_path, patch_path)
-                    if not result:
-                        print('    Failed to apply patch! Maybe the patch is already applied?')
-
-            print('')
-            print('Done.')
+    if args.action == 'analyze':
+        return analyze_targets(args)
+
+    if args.action == 'presets-search':
+        return search_presets(args)
+
+    if args.action == 'serve':
+        return serve(args)
+
+    if not args.path:
+        print('Please specify the firmware files or directories to {}.'.format(args.action))
+        return 1
+
+    if args.action == 'verify':
+        return verify(args.path, args.jobs)
+
+    if args.action == 'diff':
+        return diff_targets(args)
+
+    if args.action == 'presets-index':
+        return index_presets(args)
+
+    if args.action in ('modify', 'patch') and not (args.options or args.presets or args.preset_pack):
+        print('Please specify what modifications to make with --options, --presets or --preset-pack argument.')
+        return 1
+
+    if args.options:
+        try:
+            op1_mods.selected_mods(args.options)
+        except KeyError as e:
+            print(e.args[0])
+            return 1
+
+    # The presets are looked up once here, so the targets processed in parallel don't all query the index
+    args.preset_data = None
+    if args.presets:
+        try:
+            args.preset_data = [result['patch'] for result in query_presets(args)]
+        except ValueError as e:
+            print(e)
+            return 1
+        if not args.preset_data:
+            print('No presets in the preset library match "{}"!'.format(args.presets))
+            return 1
+    if args.preset_pack:
+        try:
+            pack_presets = load_preset_packs(args.preset_pack)
+        except (OSError, TypeError, ValueError) as e:
+            print('Failed to load preset pack: {}'.format(e))
+            return 1
+        args.preset_data = (args.preset_data or []) + pack_presets
+
+    if args.dry_run and args.action != 'modify':
+        print('--dry-run can only be used with modify.')
+        return 1
+
+    if args.action == 'extract' and not args.member:
+        print('Please specify which files to extract with --member argument.')
+        return 1
+
+    if run_targets(args):
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,72 +1,119 @@
-"""Analyze unpacked OP-1 firmware directories."""
+"""Analyze unpacked OP-1 firmware directories and firmware files."""
 
 import os
 import re
+import mmap
 import time
 
+from . import op1_repack
+
 UNKNOWN_VALUE = 'UNKNOWN'
+MAIN_LDR = 'OP1_vdk.ldr'
+BOOT_LDR = 'te-boot.ldr'
 
+# The build info line starting with "Rev." and the firmware version are found in a single scan of the main LDR
+MAIN_LDR_PATTERN = re.compile(br'(?P<rev>Rev\.)|(?P<fw_version>R\..\d\d\d\d?\d?)')
+BOOT_LDR_PATTERN = re.compile(br'TE-BOOT .+?(\d*\.?\d+)')
+
+
+def open_ldr(path):
+    """Memory map an LDR file so it can be scanned without reading it all into memory."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-def analyze_boot_ldr(target):
-    path = os.path.join(target, 'te-boot.ldr')
-    f = open(path, 'rb')
-    data = f.read()
-    f.close()
 
-    version_arr = re.findall(br'TE-BOOT .+?(\d*\.?\d+)', data)
-    bootloader_version = version_arr[0].decode('utf-8').strip() if version_arr else UNKNOWN_VALUE
+def scan_boot_ldr(data):
+    match = BOOT_LDR_PATTERN.search(data)
+    bootloader_version = match.group(1).decode('utf-8').strip() if match else UNKNOWN_VALUE
 
     return {
         'bootloader_version': bootloader_version,
     }
 
 
-def analyze_main_ldr(target):
-    path = os.path.join(target, 'OP1_vdk.ldr')
-    f = open(path, 'rb')
-    data = f.read()
-    f.close()
-
-    start_pos = data.find(b'Rev.')
-    chunk = data[start_pos:]
-    end_pos = chunk.find(b'\n')
-    chunk = chunk[:end_pos].decode('utf-8')
-
-    build_version_arr = re.findall(r'Rev.+?(.*?);', chunk)
+def scan_main_ldr(data):
+    rev_line = None
+    fw_version = None
+    for match in MAIN_LDR_PATTERN.finditer(data):
+        if match.group('rev'):
+            if rev_line is None:
+                end_pos = data.find(b'\n', match.start())
+                rev_line = data[match.start():end_pos if end_pos != -1 else len(data)].decode('utf-8')
+        elif fw_version is None:
+            fw_version = match.group('fw_version').decode('utf-8')
+        if rev_line is not None and fw_version is not None:
+            break
+    rev_line = rev_line or ''
+
+    build_version_arr = re.findall(r'Rev.+?(.*?);', rev_line)
     build_version = build_version_arr[0].strip() if build_version_arr else UNKNOWN_VALUE
 
-    date_arr = re.findall(r'\d\d\d\d/\d\d/\d\d', chunk)
-    time_arr = re.findall(r'\d\d:\d\d:\d\d', chunk)
-
-    fw_version = re.findall(br'R\..\d\d\d\d?\d?', data)
-    fw_version = UNKNOWN_VALUE if not fw_version else fw_version[0].decode('utf-8')
+    date_arr = re.findall(r'\d\d\d\d/\d\d/\d\d', rev_line)
+    time_arr = re.findall(r'\d\d:\d\d:\d\d', rev_line)
 
     return {
-        'firmware_version': str(fw_version),
+        'firmware_version': fw_version or UNKNOWN_VALUE,
         'build_version': build_version,
         'build_date': date_arr[0] if date_arr else UNKNOWN_VALUE,
         'build_time': time_arr[0] if time_arr else UNKNOWN_VALUE,
     }
 
 
-def analyze_fs(target):
+def analyze_boot_ldr(target):
+    data = open_ldr(os.path.join(target, BOOT_LDR))
+    try:
+        return scan_boot_ldr(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def analyze_main_ldr(target):
+    data = open_ldr(os.path.join(target, MAIN_LDR))
+    try:
+        return scan_main_ldr(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def file_mtimes(path, top_level=True):
+    """Yield the modification times of the files under path using the stat results of os.scandir."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # Top level dotfiles aren't part of the firmware, see OP1Repack.list_tar_inputs
+            if top_level and entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from file_mtimes(entry.path, top_level=False)
+            else:
+                yield entry.stat().st_mtime
+
+
+def mtime_range(mtimes):
     oldest = None
     newest = None
-    for root, dirs, files in os.walk(target):
-        for file in files:
-            file_path = os.path.join(root, file)
-            mtime = os.path.getmtime(file_path)
-            if oldest is None or mtime < oldest:
-                oldest = mtime
-            if newest is None or mtime > newest:
-                newest = mtime
+    for mtime in mtimes:
+        if oldest is None or mtime < oldest:
+            oldest = mtime
+        if newest is None or mtime > newest:
+            newest = mtime
+
+    def format_time(value):
+        return UNKNOWN_VALUE if value is None else time.strftime('%Y/%m/%d %H:%M', time.gmtime(value))
 
     return {
-        'oldest_file': time.strftime('%Y/%m/%d %H:%M', time.gmtime(oldest)),
-        'newest_file': time.strftime('%Y/%m/%d %H:%M', time.gmtime(newest)),
+        'oldest_file': format_time(oldest),
+        'newest_file': format_time(newest),
     }
 
 
+def analyze_fs(target):
+    return mtime_range(file_mtimes(target))
+
+
 def analyze_unpacked_fw(target):
     main_ldr_info = analyze_main_ldr(target)
     boot_ldr_info = analyze_boot_ldr(target)
@@ -77,3 +124,35 @@ def analyze_unpacked_fw(target):
         **boot_ldr_info,
         **fs_info,
     }
+
+
+def analyze_firmware_file(firmware_path, repacker):
+    """Analyze a firmware file by streaming its TAR. Only the LDR files are read into memory, nothing is written."""
+    mtimes = []
+    main_ldr_info = scan_main_ldr(b'')
+    boot_ldr_info = scan_boot_ldr(b'')
+    with open(firmware_path, 'rb') as f:
+        repacker.read_crc(f)
+        with repacker.open_tar_stream(f) as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                mtimes.append(member.mtime)
+                name = op1_repack.normalize_member_name(member.name)
+                if name == MAIN_LDR and member.isfile():
+                    main_ldr_info = scan_main_ldr(tar.extractfile(member).read())
+                elif name == BOOT_LDR and member.isfile():
+                    boot_ldr_info = scan_boot_ldr(tar.extractfile(member).read())
+
+    return {
+        **main_ldr_info,
+        **boot_ldr_info,
+        **mtime_range(mtimes),
+    }
+
+
+def analyze(path, repacker):
+    """Analyze an unpacked firmware directory or a firmware file."""
+    if os.path.isdir(path):
+        return analyze_unpacked_fw(path)
+    return analyze_firmware_file(path, repacker)
@@ -0,0 +1,80 @@
+"""Cache repacked firmware files by the contents of the unpacked firmware they were built from."""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+# The directory all the caches of op1repacker are kept in
+CACHE_ROOT = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'op1repacker',
+)
+DEFAULT_CACHE_PATH = os.path.join(CACHE_ROOT, 'repack')
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+CACHE_FILE_SUFFIX = '.op1'
+
+
+class RepackCache:
+    """Local cache of repacked firmware files with a size limit and LRU eviction.
+
+    The modification time of each cached file is updated whenever it is used,
+    so the least recently used files are evicted first.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, tree_digest, lzma_filters):
+        """Combine the digest of the firmware tree and the LZMA parameters into a cache key."""
+        key = hashlib.sha256(tree_digest.encode('utf-8'))
+        key.update(json.dumps(lzma_filters, sort_keys=True).encode('utf-8'))
+        return key.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_FILE_SUFFIX)
+
+    def get(self, key, target):
+        """Copy the cached file for key to target. Returns False if it isn't cached."""
+        path = self.entry_path(key)
+        try:
+            shutil.copyfile(path, target)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, source):
+        """Store a copy of source in the cache and evict old files if the cache is too big."""
+        os.makedirs(self.path, exist_ok=True)
+        # Copy to a temporary file first so that other processes never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(source, temp_path)
+            os.replace(temp_path, self.entry_path(key))
+        except OSError:
+            os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits in max_size."""
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith(CACHE_FILE_SUFFIX):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -0,0 +1,122 @@
+"""Keep the analysis results of many firmware files and directories in an SQLite catalog."""
+
+import os
+import sqlite3
+
+ANALYSIS_FIELDS = [
+    'firmware_version',
+    'build_version',
+    'build_date',
+    'build_time',
+    'bootloader_version',
+    'oldest_file',
+    'newest_file',
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS firmware (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    crc INTEGER,
+    {}
+);
+CREATE INDEX IF NOT EXISTS firmware_version_index ON firmware (firmware_version);
+CREATE INDEX IF NOT EXISTS build_date_index ON firmware (build_date);
+CREATE INDEX IF NOT EXISTS bootloader_version_index ON firmware (bootloader_version);
+""".format(',\n    '.join(field + ' TEXT' for field in ANALYSIS_FIELDS))
+
+
+def tree_signature(path):
+    """Return the total size and newest modification time of the files in an unpacked firmware directory."""
+    size = 0
+    mtime_ns = os.stat(path).st_mtime_ns
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                size += st.st_size
+                mtime_ns = max(mtime_ns, st.st_mtime_ns)
+    return size, mtime_ns, None
+
+
+def signature(path, repacker):
+    """Return (size, mtime_ns, crc) that change whenever the analysis results of path might change.
+
+    Firmware files are identified by their stat results and the stored checksum, directories by their contents.
+    """
+    if os.path.isdir(path):
+        return tree_signature(path)
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        crc = repacker.read_crc(f)
+    return st.st_size, st.st_mtime_ns, crc
+
+
+class FirmwareCatalog:
+    """Analysis results of firmware files and directories keyed by their path and signature."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def record(self, row):
+        return {'path': row['path'], **{field: row[field] for field in ANALYSIS_FIELDS}}
+
+    def get(self, path, signature):
+        """Return the saved results for path or None if there are none or path has changed since."""
+        row = self.conn.execute('SELECT * FROM firmware WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is None or (row['size'], row['mtime_ns'], row['crc']) != tuple(signature):
+            return None
+        return self.record(row)
+
+    def put(self, path, signature, data):
+        path = os.path.abspath(path)
+        values = [path] + list(signature) + [data.get(field) for field in ANALYSIS_FIELDS]
+        self.conn.execute('INSERT OR REPLACE INTO firmware (path, size, mtime_ns, crc, {}) VALUES ({})'.format(
+            ', '.join(ANALYSIS_FIELDS), ', '.join('?' * len(values))), values)
+        self.conn.commit()
+        return {'path': path, **{field: data.get(field) for field in ANALYSIS_FIELDS}}
+
+    def query(self, firmware_version=None, build_date=None, bootloader_version=None):
+        """Return the saved results that match all the given values sorted by path.
+
+        build_date matches by prefix, so '2019' or '2019/01' match every build of that year or month.
+        """
+        conditions = []
+        values = []
+        if firmware_version is not None:
+            conditions.append('firmware_version = ?')
+            values.append(firmware_version)
+        if build_date is not None:
+            # A range instead of LIKE so that the index can be used
+            conditions.append('build_date >= ? AND build_date < ?')
+            values.extend([build_date, build_date + '\U0010ffff'])
+        if bootloader_version is not None:
+            conditions.append('bootloader_version = ?')
+            values.append(bootloader_version)
+        sql = 'SELECT * FROM firmware'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return [self.record(row) for row in self.conn.execute(sql + ' ORDER BY path', values)]
+
+
+def matches(record, firmware_version=None, build_date=None, bootloader_version=None):
+    """Check a single record against the same values as FirmwareCatalog.query."""
+    if firmware_version is not None and record['firmware_version'] != firmware_version:
+        return False
+    if build_date is not None and not (record['build_date'] or '').startswith(build_date):
+        return False
+    if bootloader_version is not None and record['bootloader_version'] != bootloader_version:
+        return False
+    return True
@@ -1,4 +1,6 @@
+import json
 import sqlite3
+import hashlib
 import os.path
 
 
@@ -29,6 +31,11 @@ class OP1DB:
             raise FileNotFoundError("Database file doesn't exist.")
         self.conn = sqlite3.connect(path)
 
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
     def commit(self):
         self.conn.commit()
         return True
@@ -36,9 +43,7 @@ class OP1DB:
     # TODO: Don't overwrite row if id exists
     def enable_filter(self):
         # Make sure it's not already enabled
-        out = self.conn.execute('SELECT * FROM fx_types WHERE type = \'filter\'')
-        results = out.fetchall()
-        if results:
+        if self.row_exists('fx_types', 'type', 'filter'):
             return False
         new_row = (2, 'filter', '[7548, 0, 8272, 19572, 8000, 8000, 8000, 8000]')
         self.conn.execute('INSERT INTO fx_types VALUES (?,?,?)', new_row)
@@ -46,9 +51,7 @@ class OP1DB:
 
     def enable_iter(self):
         # Make sure it's not already enabled
-        out = self.conn.execute('SELECT * FROM synth_types WHERE type = \'iter\'')
-        results = out.fetchall()
-        if results:
+        if self.row_exists('synth_types', 'type', 'iter'):
             return False
         new_row = (11, 'iter', '[1516, 16704, 0, 15168, 0, 0, 0, 0]')
         self.conn.execute('INSERT INTO synth_types VALUES (?,?,?)', new_row)
@@ -74,14 +77,74 @@ class OP1DB:
     def set_fx_default_params(self, fx_type, params):
         self.conn.execute('UPDATE fx_types SET default_params=? WHERE type=?', (params, fx_type))
 
+    def row_exists(self, table, column, value):
+        # The table and column names are always given by this class, never by the user
+        sql = 'SELECT EXISTS(SELECT 1 FROM {} WHERE {}=? LIMIT 1)'.format(table, column)
+        return bool(self.conn.execute(sql, (value, )).fetchone()[0])
+
     def synth_preset_folder_exists(self, synth_type):
         # Check if there are any synth presets under the folder synth_type
-        out = self.conn.execute('SELECT * FROM synth_presets WHERE folder=?', (synth_type, ))
-        results = out.fetchall()
-        if results:
-            return True
-        return False
+        return self.row_exists('synth_presets', 'folder', synth_type)
 
     def insert_synth_preset(self, patch, folder):
         self.conn.execute('INSERT INTO synth_presets (patch, folder) VALUES (?, ?)', (patch, folder))
         return True
+
+    def import_synth_presets(self, patches, folder):
+        """Insert many synth presets in a single transaction and return the number of presets added.
+
+        patches can be patch dicts or their JSON. Presets that are already in the database
+        (under any folder) or appear more than once in patches are skipped.
+        """
+        known = set(preset_hash(row[0]) for row in self.conn.execute('SELECT patch FROM synth_presets'))
+        rows = []
+        for patch in patches:
+            patch_data = patch if isinstance(patch, str) else json.dumps(patch)
+            digest = preset_hash(patch_data)
+            if digest in known:
+                continue
+            known.add(digest)
+            rows.append((patch_data, folder))
+        if not rows:
+            return 0
+
+        # Changes made so far are committed first, the journal settings can't be changed inside a transaction
+        self.conn.commit()
+        journal_mode = self.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        synchronous = self.conn.execute('PRAGMA synchronous').fetchone()[0]
+        # The database is a working copy in unpacked firmware, so durability can be traded for speed
+        self.conn.execute('PRAGMA journal_mode=MEMORY')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        try:
+            with self.conn:
+                self.conn.executemany('INSERT INTO synth_presets (patch, folder) VALUES (?, ?)', rows)
+        finally:
+            self.conn.execute('PRAGMA journal_mode={}'.format(journal_mode))
+            self.conn.execute('PRAGMA synchronous={}'.format(int(synchronous)))
+        return len(rows)
+
+    def preset_tables(self):
+        """Return the names of the tables that store presets as patch JSON with a folder, e.g. synth_presets."""
+        tables = []
+        rows = self.conn.execute('SELECT name FROM sqlite_master WHERE type=\'table\' ORDER BY name').fetchall()
+        for (table, ) in rows:
+            columns = set(row[1] for row in self.conn.execute('PRAGMA table_info("{}")'.format(table)))
+            if table.endswith('_presets') and {'patch', 'folder'} <= columns:
+                tables.append(table)
+        return tables
+
+    def iter_presets(self):
+        """Yield (table, rowid, folder, patch JSON) of every preset one row at a time without fetching them all."""
+        for table in self.preset_tables():
+            cursor = self.conn.execute('SELECT rowid, folder, patch FROM "{}" ORDER BY rowid'.format(table))
+            for rowid, folder, patch in cursor:
+                yield table, rowid, folder, patch
+
+
+def preset_hash(patch_data):
+    """Return a hash of the contents of a preset that doesn't depend on the JSON formatting or key order."""
+    try:
+        patch_data = json.dumps(json.loads(patch_data), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        pass
+    return hashlib.sha256(patch_data.encode('utf-8')).hexdigest()
@@ -1,11 +1,19 @@
 import re
 import os
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from svg.path import parse_path
 
+from . import op1_transform
+from . import op1_workspace
+
 # String to add to patched SVGs to help detect already patched files
 PATCH_IDENTIFIER = '<!-- patched with op1repacker -->'
+# Patches applied by name get their own marker, so several patches can be applied to the same file
+PATCH_MARKER = '<!-- patched with op1repacker: {} -->'
+GFX_PATCH_SUFFIX = '.patch.json'
 
 
 def get_full_match(pat):
@@ -49,11 +57,11 @@ def move_imaginary(ima, delta):
 def path_primitive_move(primitive, delta):
     primitive.start = move_imaginary(primitive.start, delta)
     primitive.end = move_imaginary(primitive.end, delta)
-    if 'control' in dir(primitive):
+    if hasattr(primitive, 'control'):
         primitive.control = move_imaginary(primitive.control, delta)
-    if 'control1' in dir(primitive):
+    if hasattr(primitive, 'control1'):
         primitive.control1 = move_imaginary(primitive.control1, delta)
-    if 'control2' in dir(primitive):
+    if hasattr(primitive, 'control2'):
         primitive.control2 = move_imaginary(primitive.control2, delta)
 
 
@@ -92,10 +100,15 @@ def element_delta_move(pat, delta):
     return text
 
 
-def move_element(data, tag, svg_id, delta):
+def element_search(tag, svg_id):
     search = r'<' + tag + ' id="' + svg_id + '".*?/>'
     if tag == 'g':
         search = r'<' + tag + ' id="' + svg_id + '".*?/>.*?</g>'
+    return search
+
+
+def move_element(data, tag, svg_id, delta):
+    search = element_search(tag, svg_id)
     elem_data = re.sub(search, create_delta_move(delta, element_delta_move), data)
     return elem_data
 
@@ -106,54 +119,349 @@ def move_elements(data, elements, delta):
     return data
 
 
-def apply_patch(data, patch):
-    for change in patch['changes']:
-        if change['type'] == 'substitute':
-            data = re.sub(change['find'], change['replace'], data)
+def transform(data, matrix, elements=None):
+    """Apply an affine transform to the geometry of all elements, or only the given (tag, id) elements."""
+    if elements is None:
+        return op1_transform.transform_svg(data, matrix)
+    for tag, svg_id in elements:
+        data = re.sub(element_search(tag, svg_id), lambda pat: op1_transform.transform_svg(get_full_match(pat), matrix),
+                      data)
+    return data
+
+
+def apply_change(data, change):
+    """Apply a single change of a patch to the SVG data with regular expressions over the whole data."""
+    if change['type'] == 'substitute':
+        data = re.sub(change['find'], change['replace'], data)
+    if change['type'] == 'move_all':
+        data = move_all(data, change['delta'])
+    if change['type'] == 'move_element':
+        data = move_element(data, change['tag'], change['id'], change['delta'])
+    if change['type'] == 'move_elements':
+        data = move_elements(data, change['elements'], change['delta'])
+    if change['type'] == 'transform':
+        data = transform(data, change['matrix'], change.get('elements'))
+    return data
+
+
+# Comments, CDATA sections, tags and the text between them. A lone "<" is its own token so nothing is lost.
+SVG_TOKEN = re.compile(r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[^>]*>|[^<]+|<', re.DOTALL)
+SVG_ELEMENT_ID = re.compile(r'<(\w+) id="([^"]*)"')
+RECT_X = re.compile(r'<rect.*? x="(.*?)".*?/>')
+RECT_Y = re.compile(r'<rect.*? y="(.*?)".*?/>')
+# The patterns of move_all that can match anywhere, in the same order, with a quick check for each
+ATTRIBUTE_MOVES = [
+    ('x1="', re.compile(r'x1="(.*?)"'), 0, simple_delta_move),
+    ('x2="', re.compile(r'x2="(.*?)"'), 0, simple_delta_move),
+    ('y1="', re.compile(r'y1="(.*?)"'), 1, simple_delta_move),
+    ('y2="', re.compile(r'y2="(.*?)"'), 1, simple_delta_move),
+    ('cx="', re.compile(r'cx="(.*?)"'), 0, simple_delta_move),
+    ('cy="', re.compile(r'cy="(.*?)"'), 1, simple_delta_move),
+    (' d="', re.compile(r' d="(.*?)"'), None, path_delta_move),
+    (' points="', re.compile(r' points="(.*?)"'), None, polyline_delta_move),
+]
+# Text in comments or between tags that the patterns of the changes could match
+UNSAFE_TEXT = ['<', '/>', ' id="', ' x="', ' y="'] + [check for check, _, _, _ in ATTRIBUTE_MOVES]
+
+
+def is_tag(token):
+    return token.startswith('<') and not token.startswith(('<!--', '<![CDATA[')) and token != '<'
+
+
+def tag_mover(delta):
+    """Return a function that applies move_all to a single tag."""
+    rect_x = create_delta_move(delta[0], simple_delta_move)
+    rect_y = create_delta_move(delta[1], simple_delta_move)
+    moves = [(check, pattern, create_delta_move(delta if axis is None else delta[axis], func))
+             for check, pattern, axis, func in ATTRIBUTE_MOVES]
+
+    def move(tag):
+        if tag.startswith('<rect'):
+            tag = RECT_X.sub(rect_x, tag)
+            tag = RECT_Y.sub(rect_y, tag)
+        for check, pattern, repl in moves:
+            if check in tag:
+                tag = pattern.sub(repl, tag)
+        return tag
+    return move
+
+
+class SVGDocument:
+    """SVG data split into tags and text once, so each change of a patch only has to touch the tags it affects.
+
+    The changes give exactly the same results as the regular expressions of apply_change. parse() returns None
+    for data where those could match across several tags, such data has to be changed with apply_change.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        # Index of the tags by element name and id
+        self.index = {}
+        for i, token in enumerate(tokens):
+            match = SVG_ELEMENT_ID.match(token)
+            if match:
+                self.index.setdefault(match.groups(), []).append(i)
+
+    @classmethod
+    def parse(cls, data):
+        tokens = SVG_TOKEN.findall(data)
+        for token in tokens:
+            if is_tag(token):
+                # Tags with ' quotes, a > in quotes or an unclosed < aren't split like the patterns would see them
+                if token.count('"') % 2 or "'" in token or '<' in token[1:] or '/>' in token[:-2]:
+                    return None
+                if token.startswith('<rect') and not (RECT_X.fullmatch(token) and RECT_Y.fullmatch(token)):
+                    return None
+            elif token == '<':
+                return None
+            elif not token.isspace():
+                # The < that starts a comment or CDATA section is expected, text can match from its first character
+                body = token[1:] if token.startswith('<') else token
+                if any(text in body for text in UNSAFE_TEXT):
+                    return None
+        return cls(tokens)
+
+    def serialize(self):
+        return ''.join(self.tokens)
+
+    def apply(self, change):
+        """Apply a change other than substitute. Returns False without changing anything if it can't be applied."""
         if change['type'] == 'move_all':
-            data = move_all(data, change['delta'])
-        if change['type'] == 'move_element':
-            data = move_element(data, change['tag'], change['id'], change['delta'])
-        if change['type'] == 'move_elements':
-            data = move_elements(data, change['elements'], change['delta'])
+            self.move_all(change['delta'])
+        elif change['type'] == 'move_element':
+            return self.move_elements([(change['tag'], change['id'])], change['delta'])
+        elif change['type'] == 'move_elements':
+            return self.move_elements(change['elements'], change['delta'])
+        elif change['type'] == 'transform':
+            return self.transform(change['matrix'], change.get('elements'))
+        return True
+
+    def move_all(self, delta, start=0, end=None):
+        move = tag_mover(delta)
+        # Identical tags, e.g. repeated grid lines, are only moved once
+        moved = {}
+        for i in range(start, len(self.tokens) if end is None else end):
+            token = self.tokens[i]
+            if '="' in token and is_tag(token):
+                if token not in moved:
+                    moved[token] = move(token)
+                self.tokens[i] = moved[token]
+
+    def find_token(self, start, check):
+        for i in range(start, len(self.tokens)):
+            if check(self.tokens[i]):
+                return i
+        return None
+
+    def element_end(self, tag, start):
+        """Return the index of the last token move_element would match from start, or None if it wouldn't match."""
+        end = self.find_token(start, lambda token: token.endswith('/>'))
+        if end is not None and tag == 'g':
+            end = self.find_token(end + 1, lambda token: token == '</g>')
+        # The patterns don't match over line breaks
+        if end is None or any('\n' in token for token in self.tokens[start:end + 1]):
+            return None
+        return end
+
+    def element_spans(self, tag, svg_id):
+        """Return the (start, end) token ranges move_element would match for an element."""
+        spans = []
+        position = 0
+        for start in self.index.get((tag, svg_id), []):
+            # Like re.sub, matches can't overlap
+            if start < position:
+                continue
+            end = self.element_end(tag, start)
+            if end is not None:
+                spans.append((start, end + 1))
+                position = end + 1
+        return spans
+
+    def can_find_elements(self, elements):
+        for tag, svg_id in elements:
+            # The tag and id are used in a regular expression by element_search
+            if re.escape(tag) != tag or re.escape(svg_id) != svg_id or not re.fullmatch(r'\w+', tag):
+                return False
+        return True
+
+    def move_elements(self, elements, delta):
+        if not self.can_find_elements(elements):
+            return False
+
+        for tag, svg_id in elements:
+            for start, end in self.element_spans(tag, svg_id):
+                self.move_all(delta, start, end)
+        return True
+
+    def transform(self, matrix, elements=None):
+        """Transform all the tags or the tags of the given elements with a single op1_transform batch."""
+        if elements is None:
+            indexes = range(len(self.tokens))
+        elif not self.can_find_elements(elements):
+            return False
+        else:
+            indexes = [i for tag, svg_id in elements for start, end in self.element_spans(tag, svg_id)
+                       for i in range(start, end)]
+            if len(set(indexes)) < len(indexes):
+                # Elements listed more than once or inside each other are transformed once per listing
+                for tag, svg_id in elements:
+                    self.transform(matrix, [(tag, svg_id)])
+                return True
+
+        indexes = [i for i in indexes if is_tag(self.tokens[i])]
+        tags = op1_transform.transform_texts([self.tokens[i] for i in indexes], matrix)
+        for i, tag in zip(indexes, tags):
+            self.tokens[i] = tag
+        return True
+
+
+def apply_changes(data, changes):
+    """Apply the changes of a patch to SVG data, splitting the data into tags only once.
+
+    Substitutions work on the text, the other changes on the tags. Data that can't be split reliably is
+    changed with the regular expressions of apply_change instead.
+    """
+    document = None
+    for change in changes:
+        if change['type'] != 'substitute':
+            if document is None:
+                document = SVGDocument.parse(data)
+            if document is not None and document.apply(change):
+                continue
+        if document is not None:
+            data = document.serialize()
+            document = None
+        data = apply_change(data, change)
+    if document is not None:
+        data = document.serialize()
+    return data
+
+
+def patch_marker(name=None):
+    return PATCH_IDENTIFIER if name is None else PATCH_MARKER.format(name)
+
+
+def apply_patch(data, patch, name=None):
+    data = apply_changes(data, patch['changes'])
 
     # Add the patch identifier to avoid double patching
-    data = data + PATCH_IDENTIFIER
+    data = data + patch_marker(name)
 
     return data
 
 
-def is_patched(data):
-    return PATCH_IDENTIFIER in data
+def is_patched(data, name=None):
+    """Check if the data is patched with the named patch. Without a name any patch counts.
+
+    Files patched before the markers had names only have PATCH_IDENTIFIER, so they count as patched by any patch.
+    """
+    if name is None:
+        return PATCH_IDENTIFIER in data or PATCH_MARKER.split('{}')[0] in data
+    return PATCH_IDENTIFIER in data or patch_marker(name) in data
+
+
+def patch_name_from_path(patch_file):
+    name = os.path.basename(patch_file)
+    if name.endswith(GFX_PATCH_SUFFIX):
+        return name[:-len(GFX_PATCH_SUFFIX)]
+    return os.path.splitext(name)[0]
+
+
+def load_patch(patch_file):
+    with open(patch_file) as f:
+        return json.load(f)
+
+
+def patch_svg(svg_data, patches):
+    """Apply (name, patch) pairs in order to SVG data in memory.
+
+    Returns the new data, the names of the patches that were applied and skipped because they were already
+    applied or didn't change anything, a dict of error messages of the patches that couldn't be applied and a dict
+    of the time and data sizes of each patch.
+    """
+    applied = []
+    skipped = []
+    errors = {}
+    stats = {}
+    for name, patch in patches:
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        new_data = patch_svg_data(svg_data, name, patch, applied, skipped, errors)
+        stats[name] = {
+            'wall_time': time.perf_counter() - start_wall,
+            'cpu_time': time.process_time() - start_cpu,
+            'bytes_in': len(svg_data.encode('utf-8')),
+            'bytes_out': len(new_data.encode('utf-8')),
+        }
+        svg_data = new_data
+    return svg_data, applied, skipped, errors, stats
+
+
+def patch_svg_data(svg_data, name, patch, applied, skipped, errors):
+    """Apply a single patch for patch_svg and add its name to the list or dict of its outcome."""
+    if is_patched(svg_data, name):
+        skipped.append(name)
+        return svg_data
+    try:
+        new_data = apply_patch(svg_data, patch, name)
+    except (ImportError, ValueError) as e:
+        # E.g. a transform that can't be applied to some element, or NumPy isn't installed
+        errors[name] = str(e)
+        return svg_data
+    if new_data == svg_data + patch_marker(name):
+        skipped.append(name)
+        return svg_data
+    applied.append(name)
+    return new_data
+
+
+def patch_svg_file(target_file, patches, dry_run=False):
+    """Apply (name, patch) pairs in order to an SVG file, reading and writing it only once.
+
+    With dry_run nothing is written. Returns the results of patch_svg and the file sizes.
+    """
+    with open(target_file) as f:
+        svg_data = f.read()
+
+    new_data, applied, skipped, errors, stats = patch_svg(svg_data, patches)
+    if applied and not dry_run:
+        op1_workspace.unshare_file(target_file)
+        with open(target_file, 'w') as f:
+            f.write(new_data)
+
+    return {
+        'file': target_file,
+        'applied': applied,
+        'skipped': skipped,
+        'errors': errors,
+        'stats': stats,
+        'size': len(svg_data.encode('utf-8')),
+        'new_size': len(new_data.encode('utf-8')),
+    }
+
+
+def patch_image_files(fw_path, patch_files, dry_run=False, workers=None):
+    """Apply (name, patch file) pairs to the SVG files of unpacked firmware.
+
+    The patches are grouped by the file they change, so each file is read and written once with its patches
+    applied in the given order. Different files are patched in parallel processes. Returns the results of
+    patch_svg_file for each file.
+    """
+    groups = {}
+    for name, patch_file in patch_files:
+        patch = load_patch(patch_file)
+        target_file = os.path.join(fw_path, 'content', 'display', patch['file'])
+        groups.setdefault(target_file, []).append((name, patch))
+
+    if len(groups) < 2 or workers == 1:
+        return [patch_svg_file(target_file, patches, dry_run) for target_file, patches in groups.items()]
+
+    with ProcessPoolExecutor(max_workers=min(len(groups), workers or os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(patch_svg_file, target_file, patches, dry_run)
+                   for target_file, patches in groups.items()]
+        return [future.result() for future in futures]
 
 
 def patch_image_file(fw_path, patch_file):
-    # Read the patch file
-    f = open(patch_file)
-    patch_data = f.read()
-    f.close()
-    patch = json.loads(patch_data)
-
-    # Read the original SVG
-    target_file = os.path.join(fw_path, 'content', 'display', patch['file'])
-    f = open(target_file)
-    svg_data = f.read()
-    f.close()
-
-    if is_patched(svg_data):
-        return False
-
-    # Change the SVG data
-    new_data = apply_patch(svg_data, patch)
-
-    # Make sure the data got patched
-    if new_data == svg_data:
-        print('No changes made, patch already applied?')
-        return False
-
-    # Write the patched data to the SVG file
-    f = open(target_file, 'w')
-    f.write(new_data)
-    f.close()
-
-    return True
+    results = patch_image_files(fw_path, [(patch_name_from_path(patch_file), patch_file)])
+    return bool(results[0]['applied'])
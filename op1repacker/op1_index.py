@@ -0,0 +1,169 @@
+"""List and extract single members of firmware files with the help of a sidecar index."""
+
+import os
+import io
+import sys
+import json
+
+from . import op1_repack
+
+# Suffix of the index file saved next to a firmware file
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+CHUNK_SIZE = 2**20
+
+
+def index_path(firmware_path):
+    return os.path.abspath(firmware_path) + INDEX_SUFFIX
+
+
+def firmware_signature(firmware_path, repacker):
+    """Return the values used to check that an index still matches its firmware file."""
+    st = os.stat(firmware_path)
+    with open(firmware_path, 'rb') as f:
+        checksum = repacker.read_crc(f)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'crc': checksum}
+
+
+def member_type(member):
+    if member.isdir():
+        return 'dir'
+    if member.issym():
+        return 'symlink'
+    if member.islnk():
+        return 'hardlink'
+    if member.isfile():
+        return 'file'
+    return 'other'
+
+
+def build_index(firmware_path, repacker):
+    """Read through the TAR in a firmware file and record the offset and size of each member."""
+    members = []
+    with open(firmware_path, 'rb') as f:
+        repacker.read_crc(f)
+        with repacker.open_tar_stream(f) as tar:
+            for member in tar:
+                members.append({
+                    'name': op1_repack.normalize_member_name(member.name),
+                    'type': member_type(member),
+                    'offset': member.offset_data,
+                    'size': member.size,
+                    'mode': member.mode,
+                    'mtime': member.mtime,
+                    'linkname': member.linkname,
+                })
+    return members
+
+
+def load_index(firmware_path, repacker):
+    """Return the members recorded in the index of a firmware file or None if there's no valid index."""
+    try:
+        with open(index_path(firmware_path)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != INDEX_VERSION or data.get('firmware') != firmware_signature(firmware_path, repacker):
+        return None
+    return data['members']
+
+
+def save_index(firmware_path, members, repacker):
+    path = index_path(firmware_path)
+    data = {
+        'version': INDEX_VERSION,
+        'firmware': firmware_signature(firmware_path, repacker),
+        'members': members,
+    }
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def list_members(firmware_path, repacker):
+    """Return the members of a firmware file. Builds and saves the index if there isn't one yet.
+
+    The members are returned even if the index can't be saved, e.g. next to firmware in a read-only folder.
+    """
+    members = load_index(firmware_path, repacker)
+    if members is None:
+        members = build_index(firmware_path, repacker)
+        try:
+            save_index(firmware_path, members, repacker)
+        except OSError as e:
+            repacker.logger.warning('Failed to save the index of {}: {}'.format(firmware_path, e))
+    return members
+
+
+def member_target_path(target_path, name):
+    """Return the path to extract a member to, making sure it stays inside target_path."""
+    parts = name.split('/')
+    if '..' in parts or os.path.isabs(name):
+        raise ValueError('Refusing to extract member outside of the target directory: {}'.format(name))
+    return os.path.join(target_path, *parts)
+
+
+def copy_data(source, size, f):
+    while size > 0:
+        chunk = source.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError('Firmware file ended in the middle of a member')
+        f.write(chunk)
+        size -= len(chunk)
+
+
+def write_member(member, source, target_path):
+    """Write the data of a member to stdout if target_path is "-" or to a file under target_path."""
+    if target_path == '-':
+        copy_data(source, member['size'], sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        return
+    path = member_target_path(target_path, member['name'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        copy_data(source, member['size'], f)
+    os.chmod(path, member['mode'])
+    os.utime(path, (member['mtime'], member['mtime']))
+
+
+def extract_members(firmware_path, names, target_path, repacker):
+    """Extract the named members of a firmware file to target_path.
+
+    The decompression stops as soon as the last requested member has been read. With an index
+    the members are found by their offsets, without one the TAR headers are read until they're found.
+    Returns the names that weren't found.
+    """
+    wanted = set(op1_repack.normalize_member_name(name) for name in names)
+    members = load_index(firmware_path, repacker)
+
+    with open(firmware_path, 'rb') as f:
+        repacker.read_crc(f)
+        if members is not None:
+            found = sorted((m for m in members if m['name'] in wanted and m['type'] == 'file'),
+                           key=lambda m: m['offset'])
+            reader = io.BufferedReader(op1_repack.LZMAReader(f, CHUNK_SIZE), buffer_size=CHUNK_SIZE)
+            position = 0
+            for member in found:
+                # Decompress and discard everything up to the start of the member
+                while position < member['offset']:
+                    skipped = len(reader.read(min(member['offset'] - position, CHUNK_SIZE)))
+                    if not skipped:
+                        raise EOFError('Firmware file ended before member was found: {}'.format(member['name']))
+                    position += skipped
+                write_member(member, reader, target_path)
+                position += member['size']
+                wanted.discard(member['name'])
+        else:
+            with repacker.open_tar_stream(f) as tar:
+                for tarinfo in tar:
+                    name = op1_repack.normalize_member_name(tarinfo.name)
+                    if name not in wanted or not tarinfo.isfile():
+                        continue
+                    member = {'name': name, 'size': tarinfo.size, 'mode': tarinfo.mode, 'mtime': tarinfo.mtime}
+                    write_member(member, tar.extractfile(tarinfo), target_path)
+                    wanted.discard(name)
+                    if not wanted:
+                        break
+
+    return sorted(wanted)
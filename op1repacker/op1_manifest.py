@@ -0,0 +1,156 @@
+"""Build per-file manifests of firmware files and unpacked firmware and compare them."""
+
+import os
+import json
+import stat
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import op1_repack
+
+# Suffix of the manifest file saved next to an unpacked firmware directory
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 2**20
+
+
+def manifest_path(tree_path):
+    """Return the path of the manifest file saved next to an unpacked firmware directory."""
+    return os.path.normpath(os.path.abspath(tree_path)) + MANIFEST_SUFFIX
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_tree(path, prefix=''):
+    """Yield (name, os.DirEntry) for each file and link in path, skipping top level dotfiles like repack does."""
+    with os.scandir(path) as it:
+        entries = list(it)
+    for entry in entries:
+        if not prefix and entry.name.startswith('.'):
+            continue
+        name = prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_tree(entry.path, name + '/')
+        else:
+            yield name, entry
+
+
+def load_manifest(path):
+    """Load a saved manifest. Returns an empty manifest if it's missing or unreadable."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get('version') != MANIFEST_VERSION:
+        return {}
+    return data.get('files', {})
+
+
+def save_manifest(path, files):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def build_tree_manifest(tree_path, jobs=None):
+    """Build the manifest of an unpacked firmware directory.
+
+    The manifest is saved next to the directory with the stat info of each file
+    so that later calls only rehash files whose size or modification time changed.
+    """
+    saved_path = manifest_path(tree_path)
+    saved = load_manifest(saved_path)
+    files = {}
+    to_hash = []
+
+    for name, entry in scan_tree(tree_path):
+        st = entry.stat(follow_symlinks=False)
+        info = {
+            'size': st.st_size,
+            'mode': stat.S_IMODE(st.st_mode),
+            'mtime': st.st_mtime_ns,
+        }
+        if stat.S_ISLNK(st.st_mode):
+            info['sha256'] = hashlib.sha256(os.readlink(entry.path).encode('utf-8')).hexdigest()
+        else:
+            old = saved.get(name)
+            if old and old['size'] == info['size'] and old['mtime'] == info['mtime']:
+                info['sha256'] = old['sha256']
+            else:
+                to_hash.append((name, entry.path))
+        files[name] = info
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            hashes = executor.map(hash_file, [path for _, path in to_hash])
+            for (name, _), digest in zip(to_hash, hashes):
+                files[name]['sha256'] = digest
+
+    if to_hash or len(files) != len(saved):
+        save_manifest(saved_path, files)
+    return files
+
+
+def build_firmware_manifest(firmware_path):
+    """Build the manifest of a firmware file by streaming its TAR members without unpacking to disk."""
+    repacker = op1_repack.OP1Repack()
+    files = {}
+    with open(firmware_path, 'rb') as f:
+        repacker.read_crc(f)
+        with repacker.open_tar_stream(f) as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                digest = hashlib.sha256()
+                if member.issym() or member.islnk():
+                    digest.update(member.linkname.encode('utf-8'))
+                else:
+                    data = tar.extractfile(member)
+                    for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                files[op1_repack.normalize_member_name(member.name)] = {
+                    'size': member.size,
+                    'mode': member.mode,
+                    'mtime': member.mtime * 10**9,
+                    'sha256': digest.hexdigest(),
+                }
+    return files
+
+
+def build_manifest(path, jobs=None):
+    """Build the manifest of a firmware file or an unpacked firmware directory."""
+    if os.path.isdir(path):
+        return build_tree_manifest(path, jobs)
+    return build_firmware_manifest(path)
+
+
+def diff_manifests(old, new):
+    """Compare two manifests and return the lists of added, removed and changed files.
+
+    Changed files are returned as (name, old_info, new_info) tuples.
+    """
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = []
+    for name in sorted(set(old) & set(new)):
+        old_info = old[name]
+        new_info = new[name]
+        if old_info['sha256'] != new_info['sha256'] or old_info['mode'] != new_info['mode']:
+            changed.append((name, old_info, new_info))
+    return added, removed, changed
+
+
+def diff(old_path, new_path, jobs=None):
+    """Build the manifests of two firmware files or directories in parallel and compare them."""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        old = executor.submit(build_manifest, old_path, jobs)
+        new = executor.submit(build_manifest, new_path, jobs)
+        return diff_manifests(old.result(), new.result())
@@ -0,0 +1,458 @@
+"""Apply mods to unpacked firmware or to firmware members in memory.
+
+The mods that can be selected with --options are kept in a registry. Besides the built in mods, other packages
+can add mods with entry points in the "op1repacker.mods" group. An entry point refers to a Mod, a list of them or
+a function that returns either.
+
+The GFX patches are found by their file names, so the module that applies them is needed to list the mods. The
+other modules that do the actual work are imported when a mod is applied, so that looking up mods stays cheap.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import tempfile
+
+from . import op1_gfx
+from . import op1_stats
+from . import op1_workspace
+
+# Path to the app location (NOT the firmware path)
+app_path = os.path.dirname(os.path.realpath(__file__))
+
+DB_MEMBER = 'content/op1_factory.db'
+DISPLAY_MEMBER_PATH = 'content/display/'
+ENTRY_POINT_GROUP = 'op1repacker.mods'
+
+
+class Mod:
+    """A mod that can be selected with --options.
+
+    members are the names of the firmware files the mod changes. A mod of the factory database (DB_MEMBER) is
+    applied with apply(db) and returns False if it failed, failure is then printed. Other mods are applied with
+    apply(member, data) for each of their members and return the new contents of the file. Applying an
+    idempotent mod again doesn't change anything, so modify applies it again if its files were changed by something
+    else after it was applied. Changing version makes modify apply the mod again to unpacked firmware it was already
+    applied to.
+    """
+
+    def __init__(self, name, description, members, apply, idempotent=True, failure=None, version=1):
+        if DB_MEMBER in members and len(members) > 1:
+            raise ValueError('Mod "{}" can\'t change the database and other files at once'.format(name))
+        self.name = name
+        self.description = description
+        self.members = list(members)
+        self.apply = apply
+        self.idempotent = idempotent
+        self.failure = failure
+        self.version = version
+
+    @property
+    def changes_db(self):
+        return self.members == [DB_MEMBER]
+
+
+class GfxPatchMod(Mod):
+    """A GFX patch from assets/display. On unpacked firmware it's applied together with the other patches.
+
+    The patch file is only read when the mod is used, so that listing the mods stays cheap.
+    """
+
+    def __init__(self, patch_path):
+        self.patch_path = patch_path
+        self.patch_name = os.path.basename(patch_path)[:-len(op1_gfx.GFX_PATCH_SUFFIX)]
+        self.name = 'gfx-' + self.patch_name
+        self.description = 'Applying GFX patch "{}"...'.format(self.patch_name)
+        self.apply = self.apply_patch
+        self.idempotent = True
+        self.failure = None
+        self.loaded = None
+
+    def load(self):
+        """Return the patch, the members and the version of the mod, reading the patch file the first time."""
+        if self.loaded is None:
+            with open(self.patch_path, 'rb') as f:
+                data = f.read()
+            patch = json.loads(data.decode('utf-8'))
+            # The patch is applied again if it's changed
+            version = hashlib.sha256(data).hexdigest()[:16]
+            self.loaded = patch, [DISPLAY_MEMBER_PATH + patch['file']], version
+        return self.loaded
+
+    @property
+    def patch(self):
+        return self.load()[0]
+
+    @property
+    def members(self):
+        return self.load()[1]
+
+    @property
+    def version(self):
+        return self.load()[2]
+
+    def apply_patch(self, member, data):
+        # Match the newline handling of reading the file in text mode
+        svg_data = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        new_data, applied, skipped, errors, _ = op1_gfx.patch_svg(svg_data, [(self.patch_name, self.patch)])
+        for message in errors.values():
+            print('    Failed to apply patch: {}'.format(message))
+        if skipped:
+            print('    Failed to apply patch! Maybe the patch is already applied?')
+        if not applied:
+            return data
+        return new_data.encode('utf-8')
+
+
+def add_iter_presets(db):
+    if db.synth_preset_folder_exists('iter'):
+        print('    Iter already has presets, not adding new ones.')
+        return True
+
+    from . import op1_patches
+    iter_preset_path = os.path.join(app_path, 'assets', 'presets', 'iter')
+    patches = op1_patches.load_patch_folder(iter_preset_path)
+
+    for patch in patches:
+        print('    - ' + patch['name'])
+    added = db.import_synth_presets(patches, 'iter')
+    if added < len(patches):
+        print('    Skipped {} presets that are already in the database.'.format(len(patches) - added))
+    return True
+
+
+def replace_with_asset(asset_name):
+    def apply(member, data):
+        with open(os.path.join(app_path, 'assets', 'display', asset_name), 'rb') as f:
+            return f.read()
+    return apply
+
+
+def builtin_mods():
+    """Return the built in mods. The database mods are in the order they are applied."""
+    mods = [
+        Mod('iter', 'Enabling "iter" synth...', [DB_MEMBER], lambda db: db.enable_iter(),
+            failure='Failed to enable "iter". Maybe it\'s already enabled?'),
+        Mod('presets-iter', 'Adding community presets for iter:', [DB_MEMBER], add_iter_presets),
+        Mod('filter', 'Enabling "filter" effect...', [DB_MEMBER], lambda db: db.enable_filter(),
+            failure='Failed to enable "filter". Maybe it\'s already enabled?'),
+        Mod('subtle-fx', 'Modifying FX defaults to be less intensive...', [DB_MEMBER],
+            lambda db: db.enable_subtle_fx_defaults(), failure='Failed to modify default parameters for effects!'),
+        Mod('gfx-iter-lab', 'Enabling custom lab graphic for iter...', [DISPLAY_MEMBER_PATH + 'iter.svg'],
+            replace_with_asset('iter-lab.svg')),
+    ]
+    patch_paths = glob.glob(os.path.join(app_path, 'assets', 'display', '*' + op1_gfx.GFX_PATCH_SUFFIX))
+    mods.extend(GfxPatchMod(patch_path) for patch_path in sorted(patch_paths))
+    return mods
+
+
+def entry_points():
+    from importlib import metadata
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return entry_points.select(group=ENTRY_POINT_GROUP)
+    return entry_points.get(ENTRY_POINT_GROUP, [])
+
+
+def plugin_mods():
+    """Load the mods of the installed plugins. Plugins that fail to load are reported and skipped."""
+    mods = []
+    for entry_point in entry_points():
+        try:
+            loaded = entry_point.load()
+            if callable(loaded):
+                loaded = loaded()
+            loaded = [loaded] if isinstance(loaded, Mod) else list(loaded)
+            if not all(isinstance(mod, Mod) for mod in loaded):
+                raise TypeError('expected Mod objects')
+        except Exception as e:
+            print('Failed to load mods from plugin "{}": {}'.format(entry_point.name, e))
+            continue
+        mods.extend(loaded)
+    return mods
+
+
+registry = {}
+plugins_loaded = False
+
+
+def get_mods(plugins=True):
+    """Return a dict of the available mods by name, the built in ones first. Plugins are loaded only once."""
+    global plugins_loaded
+    if not registry:
+        registry.update((mod.name, mod) for mod in builtin_mods())
+    if plugins and not plugins_loaded:
+        plugins_loaded = True
+        for mod in plugin_mods():
+            # Built in mods can't be replaced
+            registry.setdefault(mod.name, mod)
+    return registry
+
+
+def selected_mods(options):
+    """Return the mods selected with options in the given order. Raises KeyError for unknown mods."""
+    mods = get_mods(plugins=False)
+    if not set(options) <= set(mods):
+        # Plugins are only loaded when a mod isn't built in
+        mods = get_mods()
+    unknown = [option for option in options if option not in mods]
+    if unknown:
+        raise KeyError('Unknown mods: {}. Available mods: {}'.format(', '.join(unknown), ', '.join(mods)))
+    return [mods[name] for name in dict.fromkeys(options)]
+
+
+def db_mods(options):
+    """Return the selected database mods in the order they are applied."""
+    selected = {mod.name for mod in selected_mods(options) if mod.changes_db}
+    return [mod for name, mod in registry.items() if name in selected]
+
+
+def db_mods_selected(options, presets=None):
+    return bool(db_mods(options)) or bool(presets)
+
+
+def import_presets(db, presets):
+    """Add presets from the preset library or preset packs to the folders of their synth types."""
+    folders = {}
+    for preset in presets:
+        folders.setdefault(preset.get('type') or 'unsorted', []).append(preset)
+    added = 0
+    for folder, patches in sorted(folders.items()):
+        added += db.import_synth_presets(patches, folder)
+    return added
+
+
+def apply_db_mods(db, options, presets=None, applied=None):
+    """Apply the selected database mods and add the given presets to an open OP1DB.
+
+    Returns False if the changes couldn't be saved. The mods that succeeded are added to the applied list once
+    the changes are saved.
+    """
+    print("Running database modifications:")
+
+    succeeded = []
+    for mod in db_mods(options):
+        print('- ' + mod.description)
+        with op1_stats.stage('db.' + mod.name):
+            if mod.apply(db):
+                succeeded.append(mod)
+            elif mod.failure:
+                print('    ' + mod.failure)
+
+    if presets:
+        print('- Adding {} presets...'.format(len(presets)))
+        with op1_stats.stage('db.presets'):
+            added = import_presets(db, presets)
+        if added < len(presets):
+            print('    Skipped {} presets that are already in the database.'.format(len(presets) - added))
+
+    # Commit changes to sqlite file
+    with op1_stats.stage('db.commit'):
+        success = db.commit()
+    if not success:
+        print('Errors occured while modifying database!')
+    elif applied is not None:
+        applied.extend(succeeded)
+
+    print('')
+    return success
+
+
+def apply_db_mods_to_file(db_path, options, presets=None, applied=None):
+    from . import op1_db
+    # SQLite changes the file in place
+    op1_workspace.unshare_file(db_path)
+    db = op1_db.OP1DB()
+    db.open(db_path)
+    try:
+        return apply_db_mods(db, options, presets, applied)
+    finally:
+        db.close()
+
+
+def format_size_change(size, new_size):
+    return '{} -> {} bytes ({:+d})'.format(size, new_size, new_size - size)
+
+
+def apply_file_mod(target_path, mod, dry_run=False):
+    """Apply a mod to the files of unpacked firmware. With dry_run nothing is written."""
+    print('- ' + mod.description)
+    for member in mod.members:
+        path = os.path.abspath(os.path.join(target_path, *member.split('/')))
+        data = b''
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+        with op1_stats.stage('gfx.' + mod.name, bytes_in=len(data)):
+            new_data = mod.apply(member, data)
+        if dry_run:
+            print('    Would change {}: {}'.format(path, format_size_change(len(data), len(new_data))))
+        elif new_data != data:
+            op1_workspace.unshare_file(path)
+            with open(path, 'wb') as f:
+                f.write(new_data)
+
+
+def apply_file_mods(target_path, options, dry_run=False, applied=None):
+    """Apply the selected mods of other files than the database to unpacked firmware.
+
+    The GFX patches are applied together, so every SVG file is written once. With dry_run nothing is written.
+    The mods that succeeded or were already in the files are added to the applied list.
+    """
+    if applied is None:
+        applied = []
+    mods = [mod for mod in selected_mods(options) if not mod.changes_db]
+    if mods:
+        print("Running graphics modifications:")
+    patch_files = []
+    patch_mods = {}
+    for mod in mods:
+        if isinstance(mod, GfxPatchMod):
+            patch_files.append((mod.patch_name, mod.patch_path))
+            patch_mods[mod.patch_name] = mod
+        else:
+            apply_file_mod(target_path, mod, dry_run)
+            applied.append(mod)
+
+    if not patch_files:
+        return
+
+    results = op1_gfx.patch_image_files(target_path, patch_files, dry_run=dry_run)
+    for result in results:
+        # The patches may run in other processes, so they're measured by patch_svg and recorded here
+        for patch_name, stats in result['stats'].items():
+            op1_stats.add_stage('gfx.' + patch_mods[patch_name].name, **stats)
+        for patch_name in result['applied']:
+            print('- Applying GFX patch "{}"...'.format(patch_name))
+        for patch_name in result['skipped']:
+            print('- Applying GFX patch "{}"...'.format(patch_name))
+            print('    Failed to apply patch! Maybe the patch is already applied?')
+        # A skipped patch has been applied to the file before
+        applied.extend(patch_mods[patch_name] for patch_name in result['applied'] + result['skipped'])
+        for patch_name, message in result['errors'].items():
+            print('- Applying GFX patch "{}"...'.format(patch_name))
+            print('    Failed to apply patch: {}'.format(message))
+        if dry_run and result['applied']:
+            size_change = format_size_change(result['size'], result['new_size'])
+            print('    Would change {}: {}'.format(result['file'], size_change))
+
+
+def print_db_mods(options, presets=None):
+    print('Database modifications that would be made:')
+    for mod in db_mods(options):
+        print('- ' + mod.name)
+    if presets:
+        print('- Adding {} presets'.format(len(presets)))
+    print('')
+
+
+def skip_applied_mods(state, options):
+    """Return the options without the mods that state says are applied and haven't changed since.
+
+    Mods that aren't idempotent aren't applied again even if their files changed, it could apply them twice.
+    """
+    from . import op1_state
+    mods = selected_mods(options)
+    known = get_mods(plugins=False)
+    changed = state.changed_mods()
+    kept = [name for name in changed if name in known and not known[name].idempotent]
+    state.forget([name for name in changed if name not in kept])
+    selected_names = [mod.name for mod in mods]
+    reapplied = [name for name in changed if name in selected_names and name not in kept]
+    if reapplied:
+        print('Files changed since these mods were applied, applying them again:')
+        for name in reapplied:
+            print('- ' + name)
+        print('')
+    refused = [name for name in kept if name in selected_names]
+    if refused:
+        print('Files changed since these mods were applied, but applying them again could apply them twice:')
+        for name in refused:
+            print('- ' + name)
+        print('Delete {} to apply them anyway.'.format(op1_state.state_path(state.tree_path)))
+        print('')
+
+    skipped = [mod.name for mod in mods if state.applied(mod) and mod.name not in refused]
+    if skipped:
+        print('Skipping mods that are already applied:')
+        for name in skipped:
+            print('- ' + name)
+        print('')
+    return [mod.name for mod in mods if mod.name not in skipped and mod.name not in refused]
+
+
+def modify(target_path, options, presets=None, dry_run=False):
+    """Apply the selected mods and add the given presets to unpacked firmware. Returns False if there were errors.
+
+    The applied mods are saved to a state file in the firmware directory and skipped when modify is run again,
+    unless they or the files they changed have changed since. With dry_run the changes are only reported and
+    nothing is written.
+    """
+    from . import op1_state
+    state = op1_state.ModState(target_path)
+    options = skip_applied_mods(state, options)
+
+    success = True
+    applied = []
+    try:
+        if db_mods_selected(options, presets):
+            if dry_run:
+                print_db_mods(options, presets)
+            else:
+                db_path = os.path.abspath(os.path.join(target_path, 'content', 'op1_factory.db'))
+                success = apply_db_mods_to_file(db_path, options, presets, applied)
+        apply_file_mods(target_path, options, dry_run, applied)
+    finally:
+        if not dry_run and (applied or presets or state.changed):
+            state.record(applied)
+            state.save()
+    return success
+
+
+def db_member_change(options, presets=None):
+    """Return a function that applies the selected database mods to the contents of the database file."""
+    def change(data):
+        # SQLite needs a real file, so the database is modified in a temporary file
+        fd, temp_path = tempfile.mkstemp(suffix='.db')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            if not apply_db_mods_to_file(temp_path, options, presets):
+                raise RuntimeError('Errors occured while modifying database!')
+            with open(temp_path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(temp_path)
+    return change
+
+
+def file_member_change(mod, member):
+    """Return a function that applies a mod to the contents of one of its members."""
+    def change(data):
+        print('- ' + mod.description)
+        with op1_stats.stage('gfx.' + mod.name, bytes_in=len(data)):
+            return mod.apply(member, data)
+    return change
+
+
+def member_changes(options, presets=None):
+    """Return a dict of firmware member names and functions that apply the selected mods to their contents."""
+    changes = {}
+    if db_mods_selected(options, presets):
+        changes[DB_MEMBER] = [db_member_change(options, presets)]
+    for mod in selected_mods(options):
+        if mod.changes_db:
+            continue
+        for member in mod.members:
+            changes.setdefault(member, []).append(file_member_change(mod, member))
+
+    return {name: combine_changes(funcs) for name, funcs in changes.items()}
+
+
+def combine_changes(funcs):
+    def change(data):
+        for func in funcs:
+            data = func(data)
+        return data
+    return change
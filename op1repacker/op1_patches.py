@@ -1,42 +1,215 @@
+import io
 import os
+import re
+import copy
 import json
 import struct
+import functools
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
+PATCH_EXTENSIONS = ('aif', 'aiff')
 
-def load_patch_folder(path):
-    patch_files = [name for name in os.listdir(path) if name.lower().endswith('aif')]
+# Exported patches are written like the OP-1 writes them: AIFF-C with 16 bit little endian mono PCM
+AIFC_VERSION = 0xA2805140
+# The sample rate as an 80 bit float, exactly as the OP-1 writes it
+SAMPLE_RATE_80BIT = bytes.fromhex('400dac44000000000000')
+COMPRESSION_TYPE = b'sowt'
+COMPRESSION_NAME = b'Signed integer (little-endian) linear PCM'
+# The patches saved by the OP-1 have a short recording of the sound, exported patches get silence of the same length
+SAMPLE_FRAMES = 28896
+EXPORT_THREADS = 4
+LOAD_THREADS = 8
+# Number of parsed patch files to keep in memory
+CACHE_SIZE = 16384
 
-    patches = []
 
-    for file_name in patch_files:
-        patch_name = os.path.splitext(file_name)[0]
-        patch_data = read_patch(os.path.join(path, file_name))
+def is_patch_file(name):
+    return name.lower().endswith(PATCH_EXTENSIONS)
+
+
+def patch_name_from_path(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def load_patch_folder(path, threads=LOAD_THREADS):
+    """Load the patches in a folder and its subfolders. The files are picked like the files of archives."""
+    patch_files = [os.path.join(root, name) for root, dirs, files in os.walk(path)
+                   for name in files if is_patch_file(name)]
+
+    # Only the chunk headers and the patch data are read, so the files are mostly waiting on I/O
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        patches = list(executor.map(read_patch, patch_files))
+
+    for patch_file, patch_data in zip(patch_files, patches):
         # Set the patch data name based on the filename of the patch
         # TODO: option for normalizing patch names
-        patch_data['name'] = patch_name
-        patches.append(patch_data)
+        patch_data['name'] = patch_name_from_path(patch_file)
 
     return patches
 
 
+def read_archive_patch(name, f):
+    try:
+        patch_data = read_appl_data(f)
+    except (TypeError, ValueError) as e:
+        raise ValueError('{}: {}'.format(name, e))
+    patch_data['name'] = patch_name_from_path(name)
+    return patch_data
+
+
+def read_zip_patch(archive, info):
+    with archive.open(info) as f:
+        return read_archive_patch(info.filename, f)
+
+
+def load_patch_archive(path, threads=LOAD_THREADS):
+    """Load the patches in a ZIP or TAR archive, e.g. a downloaded preset pack, without extracting it.
+
+    Only the chunk headers and the patch data of each file are read. The files of a ZIP archive are read by a pool
+    of threads, a TAR archive can only be read in order. Raises ValueError if the archive or a patch in it can't be
+    read.
+    """
+    try:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                infos = [info for info in archive.infolist() if not info.is_dir() and is_patch_file(info.filename)]
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    return list(executor.map(lambda info: read_zip_patch(archive, info), infos))
+
+        if not tarfile.is_tarfile(path):
+            raise ValueError('Not a folder, ZIP or TAR archive: {}'.format(path))
+        patches = []
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if member.isfile() and is_patch_file(member.name):
+                    patches.append(read_archive_patch(member.name, archive.extractfile(member)))
+        return patches
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        raise ValueError('Failed to read {}: {}'.format(path, e))
+
+
+def load_patches(path):
+    """Load the patches in a folder or an archive."""
+    if os.path.isdir(path):
+        return load_patch_folder(path)
+    return load_patch_archive(path)
+
+
+def iff_chunk(chunk_id, data):
+    # Chunks are padded to an even length, the pad byte isn't counted in the size
+    return chunk_id + struct.pack('>L', len(data)) + data + b'\0' * (len(data) & 1)
+
+
+def patch_to_aiff(patch_data):
+    """Return the AIFF file contents of a patch given as a dict or its JSON."""
+    if not isinstance(patch_data, str):
+        patch_data = json.dumps(patch_data)
+    appl_data = b'op-1' + patch_data.strip().encode('utf-8') + b'\n'
+    if len(appl_data) & 1:
+        # The OP-1 pads the patch data with a space instead of a null byte
+        appl_data += b' '
+
+    comm_data = (struct.pack('>hLh', 1, SAMPLE_FRAMES, 16) + SAMPLE_RATE_80BIT + COMPRESSION_TYPE +
+                 bytes([len(COMPRESSION_NAME)]) + COMPRESSION_NAME)
+    if len(COMPRESSION_NAME) % 2 == 0:
+        comm_data += b'\0'
+    chunks = (iff_chunk(b'FVER', struct.pack('>L', AIFC_VERSION)) +
+              iff_chunk(b'COMM', comm_data) +
+              iff_chunk(b'APPL', appl_data) +
+              iff_chunk(b'SSND', struct.pack('>LL', 0, 0) + bytes(SAMPLE_FRAMES * 2)))
+    return b'FORM' + struct.pack('>L', len(chunks) + 4) + b'AIFC' + chunks
+
+
+def write_patch(path, patch_data):
+    with open(path, 'wb') as f:
+        f.write(patch_to_aiff(patch_data))
+
+
+def safe_file_name(name, fallback):
+    """Return name with the characters that aren't safe in file names replaced, or fallback if nothing is left."""
+    name = re.sub(r'[^\w\-. ]', '_', str(name or '')).strip(' .')
+    return name or str(fallback)
+
+
+def patch_file_name(patch_data, fallback):
+    """Return a file name for a patch based on its name, or fallback if it doesn't have a name."""
+    try:
+        name = json.loads(patch_data).get('name')
+    except (ValueError, AttributeError):
+        name = None
+    return safe_file_name(name, fallback)
+
+
+def export_presets(db, target_path, threads=EXPORT_THREADS):
+    """Write every preset in an open OP1DB to target_path/table/folder/name.aif and return the number written.
+
+    The rows are read one at a time while the files are written by a pool of threads.
+    """
+    count = 0
+    used_paths = set()
+    pending = set()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for table, rowid, folder, patch_data in db.iter_presets():
+            folder_path = os.path.join(target_path, table, safe_file_name(folder, 'unsorted'))
+            name = patch_file_name(patch_data, rowid)
+            path = os.path.join(folder_path, name + '.aif')
+            if path in used_paths:
+                path = os.path.join(folder_path, '{}_{}.aif'.format(name, rowid))
+            used_paths.add(path)
+            os.makedirs(folder_path, exist_ok=True)
+
+            # Limit the number of patches waiting to be written so they don't pile up in memory
+            if len(pending) >= threads * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(write_patch, path, patch_data))
+            count += 1
+        for future in pending:
+            future.result()
+    return count
+
+
 def read_patch(patch_filename):
-    f = open(patch_filename, 'rb')
-    data = f.read()
-    f.close()
+    """Read the patch data of an AIFF file. The result is cached until the size or modification time changes."""
+    st = os.stat(patch_filename)
+    patch_data = read_patch_cached(os.path.abspath(patch_filename), st.st_size, st.st_mtime_ns)
+    # The callers modify the patch data, e.g. the name, so they get their own copy
+    return copy.deepcopy(patch_data)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def read_patch_cached(path, size, mtime_ns):
+    with open(path, 'rb') as f:
+        return read_appl_data(f)
+
 
-    # Locate start of APPL chunk
-    appl_pos = data.find(bytes('APPL', 'utf-8'))
-    if appl_pos == -1:
-        raise TypeError('Invalid file. No APPL data found.')
-    appl_pos += 4
+def parse_patch(data):
+    return read_appl_data(io.BytesIO(data))
 
-    appl_chunk = data[appl_pos:]
-    appl_data_len = struct.unpack('>l', appl_chunk[:4])[0]
 
-    appl_data_bin = appl_chunk[4:appl_data_len+4]
-    appl_data = str(appl_data_bin, 'utf-8').strip()
+def read_appl_data(f):
+    """Walk the chunks of an AIFF file and return the patch data from its APPL chunk.
 
-    if appl_data.startswith('op-1'):
-        appl_data = appl_data[4:]
+    Only the chunk headers and the APPL chunk are read, the rest (mostly audio) is skipped.
+    """
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'FORM' or header[8:] not in (b'AIFF', b'AIFC'):
+        raise TypeError('Invalid file. Not an AIFF file.')
 
-    return json.loads(appl_data)
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise TypeError('Invalid file. No APPL data found.')
+        chunk_id = chunk_header[:4]
+        size = struct.unpack('>L', chunk_header[4:])[0]
+        if chunk_id == b'APPL':
+            appl_data = str(f.read(size), 'utf-8').strip()
+            # The OP-1 starts the chunk with its signature, patches from other tools may not have it
+            if appl_data.startswith('op-1'):
+                appl_data = appl_data[4:]
+            return json.loads(appl_data)
+        # Chunks are padded to an even length
+        f.seek(size + (size & 1), io.SEEK_CUR)
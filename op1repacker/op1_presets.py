@@ -0,0 +1,199 @@
+"""Index collections of .aif presets in SQLite so they can be searched by synth type, tags and parameters."""
+
+import os
+import re
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from . import op1_db
+from . import op1_cache
+from . import op1_patches
+
+DEFAULT_INDEX_PATH = os.path.join(op1_cache.CACHE_ROOT, 'presets.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presets (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    name TEXT,
+    type TEXT,
+    hash TEXT,
+    patch TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT NOT NULL REFERENCES presets (path) ON DELETE CASCADE,
+    tag TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS params (
+    path TEXT NOT NULL REFERENCES presets (path) ON DELETE CASCADE,
+    param TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS presets_type_index ON presets (type);
+CREATE INDEX IF NOT EXISTS presets_hash_index ON presets (hash);
+CREATE INDEX IF NOT EXISTS tags_index ON tags (tag, path);
+CREATE INDEX IF NOT EXISTS tags_path_index ON tags (path);
+CREATE INDEX IF NOT EXISTS params_index ON params (param, position, value);
+CREATE INDEX IF NOT EXISTS params_path_index ON params (path);
+"""
+
+# A query is made of space separated terms like: type=iter tag=bass name=wood* adsr[0]>=1000
+QUERY_TERM = re.compile(r'^(?P<key>\w+)(?:\[(?P<position>\d+)\])?(?P<op><=|>=|=|<|>)(?P<value>.*)$')
+QUERY_OPS = {'=': '=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+
+
+def scan_patch_files(path):
+    """Yield (path, stat result) of the patch files under path using os.scandir."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield from scan_patch_files(entry.path)
+            elif entry.name.lower().endswith(op1_patches.PATCH_EXTENSIONS) and entry.is_file():
+                yield entry.path, entry.stat()
+
+
+def path_tags(path, root):
+    """Return the names of the folders between root and a file as the tags of the file."""
+    # E.g. root/community/bass/x.aif is tagged with community and bass
+    folder = os.path.relpath(os.path.dirname(path), root)
+    if folder == os.curdir:
+        return []
+    return [part.lower() for part in folder.split(os.sep)]
+
+
+def parse_query(query):
+    """Parse a query string into a list of (key, position, operator, value) terms. Raises ValueError if invalid."""
+    terms = []
+    for term in query.split():
+        match = QUERY_TERM.match(term)
+        if not match:
+            raise ValueError('Invalid preset query term: {}'.format(term))
+        key, position, op, value = match.group('key', 'position', 'op', 'value')
+        if key in ('type', 'tag', 'name'):
+            if position is not None or op != '=':
+                raise ValueError('Only "=" can be used with {}: {}'.format(key, term))
+        else:
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError('Parameter values must be numbers: {}'.format(term))
+        terms.append((key, None if position is None else int(position), op, value))
+    return terms
+
+
+class PresetIndex:
+    """SQLite index of the presets found under any number of folders."""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def scan(self, root, threads=op1_patches.LOAD_THREADS):
+        """Add the presets under root to the index, only reading the files that are new or have changed.
+
+        Presets of files under root that don't exist anymore are removed. Returns (added or updated, removed).
+        """
+        root = os.path.abspath(root)
+        known = {}
+        for row in self.conn.execute('SELECT path, size, mtime_ns FROM presets WHERE path >= ? AND path < ?',
+                                     (root + os.sep, root + os.sep + '\U0010ffff')):
+            known[row['path']] = (row['size'], row['mtime_ns'])
+
+        changed = []
+        found = set()
+        for path, st in scan_patch_files(root):
+            found.add(path)
+            if known.get(path) != (st.st_size, st.st_mtime_ns):
+                changed.append((path, st))
+        removed = [path for path in known if path not in found]
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            patches = list(executor.map(self.read_patch, [path for path, _ in changed]))
+
+        with self.conn:
+            self.conn.executemany('DELETE FROM presets WHERE path = ?', [(path,) for path in removed])
+            for (path, st), patch_data in zip(changed, patches):
+                self.conn.execute('DELETE FROM presets WHERE path = ?', (path, ))
+                self.add(path, st, patch_data, path_tags(path, root))
+        return len(changed), len(removed)
+
+    def read_patch(self, path):
+        try:
+            return op1_patches.read_patch(path)
+        except (OSError, TypeError, ValueError):
+            # Files that aren't valid patches are indexed without data so they aren't read again until they change
+            return None
+
+    def add(self, path, st, patch_data, tags):
+        if patch_data is None:
+            self.conn.execute('INSERT INTO presets (path, size, mtime_ns) VALUES (?, ?, ?)',
+                              (path, st.st_size, st.st_mtime_ns))
+            return
+        # Name the preset after its file like load_patch_folder does
+        patch_data['name'] = op1_patches.patch_name_from_path(path)
+        patch_json = json.dumps(patch_data)
+        self.conn.execute('INSERT INTO presets VALUES (?, ?, ?, ?, ?, ?, ?)', (
+            path, st.st_size, st.st_mtime_ns, patch_data['name'], patch_data.get('type'),
+            op1_db.preset_hash(patch_json), patch_json))
+        self.conn.executemany('INSERT INTO tags VALUES (?, ?)', [(path, tag) for tag in tags])
+        params = []
+        for param, values in patch_data.items():
+            if not isinstance(values, list):
+                continue
+            for position, value in enumerate(values):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    params.append((path, param, position, value))
+        self.conn.executemany('INSERT INTO params VALUES (?, ?, ?, ?)', params)
+
+    def query(self, terms):
+        """Return the presets matching all the parsed query terms, sorted by path.
+
+        Each result has the path, name, type, hash and the patch data.
+        """
+        conditions = ['patch IS NOT NULL']
+        values = []
+        for key, position, op, value in terms:
+            if key == 'type':
+                conditions.append('type = ?')
+                values.append(value)
+            elif key == 'tag':
+                conditions.append('EXISTS (SELECT 1 FROM tags WHERE tags.path = presets.path AND tag = ?)')
+                values.append(value.lower())
+            elif key == 'name':
+                conditions.append('name GLOB ?')
+                values.append(value)
+            else:
+                # Without a position any value of the parameter array can match
+                sql = 'EXISTS (SELECT 1 FROM params WHERE params.path = presets.path AND param = ? AND value {} ?'
+                values.append(key)
+                if position is not None:
+                    sql += ' AND position = ?'
+                    values.extend([value, position])
+                else:
+                    values.append(value)
+                conditions.append(sql.format(QUERY_OPS[op]) + ')')
+
+        sql = 'SELECT path, name, type, hash, patch FROM presets WHERE {} ORDER BY path'
+        sql = sql.format(' AND '.join(conditions))
+        results = []
+        for row in self.conn.execute(sql, values):
+            results.append({
+                'path': row['path'],
+                'name': row['name'],
+                'type': row['type'],
+                'hash': row['hash'],
+                'patch': json.loads(row['patch']),
+            })
+        return results
@@ -1,14 +1,96 @@
 #!/usr/bin/env python3
 """Unpack and repack OP1 firmware in order to create custom firmware."""
 
+import io
 import os
 import stat
 import lzma
+import time
 import shutil
+import hashlib
 import struct
 import tarfile
 import logging
 import binascii
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import op1_stats
+
+# Members are checked by OP1Repack.extract_filter, Python versions with extraction filters would warn without this
+EXTRACT_ARGS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+# Errors raised while reading truncated or corrupt firmware files
+FIRMWARE_ERRORS = (EOFError, lzma.LZMAError, tarfile.TarError)
+
+
+class UnsafeMemberError(tarfile.TarError):
+    """A TAR member would be extracted outside of the target directory or isn't a regular file, folder or link."""
+
+
+class MissingMemberError(tarfile.TarError):
+    """Members that should be changed aren't files in the firmware."""
+
+
+def normalize_member_name(name):
+    """Return a TAR member name without a leading "./" or "/" so it can be compared to relative paths."""
+    while name.startswith('./'):
+        name = name[2:]
+    return name.lstrip('/')
+
+
+class LZMAReader(io.RawIOBase):
+    """Readable file object that decompresses an LZMA stream from fileobj on the fly."""
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decompressor = lzma.LZMADecompressor()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.decompressor.eof:
+            data = b''
+            if self.decompressor.needs_input:
+                data = self.fileobj.read(self.chunk_size)
+                if not data:
+                    raise EOFError('Compressed data ended before the end-of-stream marker was reached')
+            # Limit the output to the size of the buffer to keep memory usage bounded
+            data = self.decompressor.decompress(data, len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+        return 0
+
+
+class LZMAWriter(io.RawIOBase):
+    """Writable file object that LZMA compresses data into fileobj and keeps a CRC-32 of the output."""
+
+    def __init__(self, fileobj, filters):
+        self.fileobj = fileobj
+        self.compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE, filters=filters)
+        self.crc = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self.output(self.compressor.compress(data))
+        return len(data)
+
+    def finish(self):
+        """Flush the remaining compressed data to fileobj."""
+        self.output(self.compressor.flush())
+
+    def output(self, data):
+        if data:
+            self.crc = binascii.crc32(data, self.crc)
+            self.bytes_out += len(data)
+            self.fileobj.write(data)
 
 
 class OP1Repack:
@@ -26,20 +108,25 @@ class OP1Repack:
         self.logger = logging.getLogger()
         if debug:
             self.logger.setLevel(logging.DEBUG)
-        # Temporary file suffix to use when unpacking
+        # Temporary file suffix used by create_temp_file
         self.temp_file_suffix = '.unpacking'
         # Suffix to add when to FW file when it's repacked
         self.repack_file_suffix = '-repacked.op1'
+        # Size of the chunks to read and decompress at a time when streaming
+        self.chunk_size = 2**20
+        # Getting these LZMA parameters right was a huge pain in the ass. I do not recommend touching them. The OP-1
+        # only accepts max 15mb firwmare files. But using agressive compression requires more ram to decompress.
+        # When using the most agressive preset 9, the OP-1 fails to allocate enough RAM to perform the decompression.
+        # I found that these settings work pretty well. The resulting firmware is under 15mb and it installs fine.
+        self.lzma_filters = [
+            {'id': lzma.FILTER_LZMA1, 'preset': 9, 'lc': 3, 'lp': 1, 'pb': 2, 'dict_size': 2**23},
+        ]
 
-    def create_temp_file(self, from_path):
-        """Create a temporary file for the unpacking procedure and return its path."""
-        to_path = from_path + self.temp_file_suffix
-        shutil.copy(from_path, to_path)
-        return to_path
+    def unpack(self, input_path, threads=None, target_path=None):
+        """Unpack OP-1 firmware. The files are written with a pool of threads if threads is more than 1.
 
-    def unpack(self, input_path):
-        """Unpack OP-1 firmware."""
-        # TODO: maybe do all this in memory without the temp file
+        The files are unpacked next to the firmware file unless target_path is given.
+        """
         path = os.path.abspath(input_path)
         if not os.path.isfile(input_path):
             self.logger.error("Firmware file doesn't exist: {}".format(input_path))
@@ -47,23 +134,24 @@ class OP1Repack:
         root_path = os.path.dirname(path)
         target_file = os.path.basename(input_path)
         full_path = os.path.join(root_path, target_file)
-        target_path = os.path.join(root_path, os.path.splitext(target_file)[0])
+        if target_path is None:
+            target_path = os.path.join(root_path, os.path.splitext(target_file)[0])
 
         self.logger.debug('Unpacking firmware file: {}'.format(full_path))
-        temp_file_path = self.create_temp_file(path)
-        self.remove_crc(temp_file_path)
-        self.uncompress_lzma(temp_file_path, temp_file_path)
-        self.uncompress_tar(temp_file_path, target_path)
-        os.remove(temp_file_path)
-        # Don't mess with permissions on Windows
-        if os.name != 'nt':
-            self.set_permissions(target_path)
+        try:
+            with open(path, 'rb') as f:
+                if not self.check_open_crc(f):
+                    self.logger.error('Checksum mismatch, the firmware file is corrupted: {}'.format(input_path))
+                    return False
+                self.uncompress_stream(f, target_path, threads)
+        except FIRMWARE_ERRORS as e:
+            self.logger.error('Failed to unpack firmware file: {}'.format(e))
+            return False
         self.logger.debug('Unpacking complete!')
         return True
 
-    def repack(self, input_path):
-        """Repack OP-1 firmware."""
-        # TODO: maybe do all this in memory without the temp file
+    def repack(self, input_path, cache=None):
+        """Repack OP-1 firmware. Uses and updates the repack cache if one is given."""
         path = os.path.abspath(input_path)
         if not os.path.isdir(path):
             self.logger.error("Given path isn't a directory: {}".format(input_path))
@@ -73,68 +161,245 @@ class OP1Repack:
         compress_from = os.path.join(root_path, target_file)
         compress_to = os.path.join(root_path, target_file + self.repack_file_suffix)
         self.logger.debug('Repacking firmware from: {}'.format(compress_from))
-        self.compress_tar(compress_from, compress_to)
-        self.compress_lzma(compress_to)
-        self.add_crc(compress_to)
+        if cache is not None:
+            with op1_stats.stage('tree_digest'):
+                cache_key = cache.key(self.tree_digest(compress_from), self.lzma_filters)
+            with op1_stats.stage('cache_get'):
+                cached = cache.get(cache_key, compress_to)
+            if cached:
+                self.logger.debug('Using cached firmware: {}'.format(cache.entry_path(cache_key)))
+                return True
+        self.compress_stream(compress_from, compress_to)
+        if cache is not None:
+            try:
+                with op1_stats.stage('cache_put'):
+                    cache.put(cache_key, compress_to)
+            except OSError as e:
+                # The firmware was repacked fine, it just won't be cached
+                self.logger.warning('Failed to cache the repacked firmware: {}'.format(e))
         self.logger.debug('Repacking complete!')
         return True
 
-    def remove_crc(self, path):
-        """Remove the first 4 bytes of the firmware which contain the CRC-32 checksum."""
-        with open(path, 'rb') as f:
-            data = f.read()
+    def patch(self, input_path, changes):
+        """Write a new firmware file with some members changed, without unpacking to disk.
+
+        changes is a dict of member names and functions that take the contents of the
+        member and return the new contents. All other members are copied as they are.
+        """
+        path = os.path.abspath(input_path)
+        if not os.path.isfile(path):
+            self.logger.error("Firmware file doesn't exist: {}".format(input_path))
+            return False
+        root_path = os.path.dirname(path)
+        target_file = os.path.splitext(os.path.basename(path))[0]
+        patch_to = os.path.join(root_path, target_file + self.repack_file_suffix)
+
+        self.logger.debug('Patching firmware file {} to: {}'.format(path, patch_to))
+        try:
+            with open(path, 'rb') as f:
+                if not self.check_open_crc(f):
+                    self.logger.error('Checksum mismatch, the firmware file is corrupted: {}'.format(input_path))
+                    return False
+                with self.open_tar_stream(f) as tar:
+                    self.compress_members(tar, patch_to, changes)
+        except (EOFError, lzma.LZMAError, tarfile.TarError, RuntimeError) as e:
+            self.logger.error('Failed to patch firmware file: {}'.format(e))
+            # Don't leave a broken firmware file behind
+            if os.path.exists(patch_to):
+                os.remove(patch_to)
+            return False
+        self.logger.debug('Patching complete!')
+        return True
+
+    def compress_members(self, tar, target, changes):
+        """Compress the members of an open TAR into the target firmware file, changing some on the way.
 
-        checksum_data = data[:4]
+        Raises MissingMemberError if some of the changed members aren't files in the TAR.
+        """
+        unused = set(changes)
+        with self.open_firmware_writer(target, 'patch_stream') as out:
+            for member in tar:
+                member = self.tarinfo_reset(member)
+                if not member.isfile():
+                    out.addfile(member)
+                    continue
+                name = normalize_member_name(member.name)
+                change = changes.get(name)
+                if change is None:
+                    out.addfile(member, tar.extractfile(member))
+                    continue
+                unused.discard(name)
+                self.logger.debug('Changing member: {}'.format(member.name))
+                data = change(tar.extractfile(member).read())
+                member.size = len(data)
+                member.mtime = int(time.time())
+                out.addfile(member, io.BytesIO(data))
+            if unused:
+                raise MissingMemberError('Files to change not found in the firmware: {}'.format(
+                    ', '.join(sorted(unused))))
+
+    def read_crc(self, f):
+        """Read the CRC-32 checksum from the first 4 bytes of an open firmware file."""
+        checksum_data = f.read(4)
+        if len(checksum_data) != 4:
+            raise EOFError('Firmware file is too short to contain a checksum')
         checksum = struct.unpack('<L', checksum_data)[0]
-        self.logger.debug('Removing checksum: {}'.format(checksum))
+        self.logger.debug('Read checksum: {}'.format(checksum))
+        return checksum
 
-        with open(path, 'wb') as f:
-            f.write(data[4:])
+    def check_open_crc(self, f):
+        """Check the checksum of an open firmware file and leave it positioned right after the checksum."""
+        with op1_stats.stage('check_crc') as info:
+            start = f.tell()
+            checksum = self.read_crc(f)
+            calced_crc = self.calculate_crc(f)
+            info.bytes_in = f.tell() - start
+        f.seek(start + 4)
+        return checksum == calced_crc
 
-    def add_crc(self, path):
-        """Generates and adds a CRC to the beginning of a file."""
-        with open(path, 'rb') as f:
-            data = f.read()
+    def calculate_crc(self, f):
+        """Calculate the CRC-32 checksum of the rest of an open file one chunk at a time."""
+        crc = 0
+        for chunk in iter(lambda: f.read(self.chunk_size), b''):
+            crc = binascii.crc32(chunk, crc)
+        return crc
 
-        # Calculate our CRC
-        calced_crc = binascii.crc32(data)
-        self.logger.debug('Adding checksum {} to {}'.format(calced_crc, path))
-        # Convert the integer to binary with little endian
-        bin_crc = struct.pack('<L', calced_crc)
+    def check_crc(self, input_path):
+        """Return the stored and the calculated CRC-32 checksums of a firmware file."""
+        with open(input_path, 'rb') as f:
+            checksum = self.read_crc(f)
+            calced_crc = self.calculate_crc(f)
+        self.logger.debug('Calculated checksum: {}'.format(calced_crc))
+        return checksum, calced_crc
 
-        # Write the new CRC with the data back to the file
-        with open(path, 'wb') as f:
-            f.write(bin_crc + data)
+    def verify(self, input_path):
+        """Check that the checksum stored in a firmware file matches its contents."""
+        checksum, calced_crc = self.check_crc(input_path)
+        return checksum == calced_crc
 
-    def uncompress_lzma(self, target_file, target_path):
-        """Uncompress LZMA target_file contents to target_path."""
-        self.logger.debug('Uncompressing LZMA...')
-        with lzma.open(target_file) as f:
-            data = f.read()
-        with open(target_path, 'wb') as f:
+    def uncompress_stream(self, f, target_path, threads=None):
+        """Uncompress the LZMA compressed TAR from the open file f to target_path one chunk at a time."""
+        self.logger.debug('Uncompressing LZMA stream to "{}"...'.format(target_path))
+        with op1_stats.stage('uncompress_stream') as info:
+            start = f.tell()
+            with self.open_tar_stream(f) as tar:
+                self.extract_tar(tar, target_path, threads)
+                info.bytes_out = tar.offset
+            info.bytes_in = f.tell() - start
+
+    def extract_filter(self, member, dest_path):
+        """Check that a TAR member is safe to extract to dest_path and make folders accessible.
+
+        Works like the extraction filters of tarfile: returns the member to extract or raises UnsafeMemberError.
+        """
+        name = member.name.lstrip('/' + os.sep)
+        dest_path = os.path.realpath(dest_path)
+        member_path = os.path.realpath(os.path.join(dest_path, name))
+        if os.path.isabs(name) or not self.is_inside(dest_path, member_path):
+            raise UnsafeMemberError('Member would be extracted outside of the target directory: {}'.format(member.name))
+
+        if member.issym():
+            if os.path.isabs(member.linkname):
+                raise UnsafeMemberError('Member links to an absolute path: {}'.format(member.name))
+            link_path = os.path.join(os.path.dirname(member_path), member.linkname)
+        elif member.islnk():
+            link_path = os.path.join(dest_path, member.linkname.lstrip('/' + os.sep))
+        elif not (member.isreg() or member.isdir()):
+            raise UnsafeMemberError('Member is a special file: {}'.format(member.name))
+        else:
+            link_path = None
+        if link_path is not None and not self.is_inside(dest_path, os.path.realpath(link_path)):
+            raise UnsafeMemberError('Member links outside of the target directory: {}'.format(member.name))
+
+        member.name = name
+        # Make the unpacked folders accessible, don't mess with permissions on Windows
+        if member.isdir() and os.name != 'nt':
+            member.mode |= stat.S_IEXEC
+        return member
+
+    def is_inside(self, dest_path, path):
+        return os.path.commonpath([dest_path, path]) == dest_path
+
+    def filter_members(self, tar, dest_path):
+        """Yield the members of an open TAR passed through extract_filter one at a time."""
+        for member in tar:
+            yield self.extract_filter(member, dest_path)
+
+    def extract_tar(self, tar, target_path, threads=None):
+        """Extract an open TAR to target_path with the members checked by extract_filter as they're read.
+
+        With threads more than 1 the file contents are written by a pool of threads while the next members are read.
+        """
+        members = self.filter_members(tar, target_path)
+        if not threads or threads <= 1:
+            tar.extractall(target_path, members=members, **EXTRACT_ARGS)
+            return
+
+        directories = []
+        pending = set()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for member in members:
+                member_path = os.path.join(target_path, member.name)
+                if member.isdir():
+                    os.makedirs(member_path, exist_ok=True)
+                    directories.append(member)
+                elif member.isreg():
+                    # Limit the number of files waiting to be written so their contents don't pile up in memory
+                    if len(pending) >= threads * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                    data = tar.extractfile(member).read()
+                    pending.add(executor.submit(self.write_member_file, member_path, data, member))
+                else:
+                    # Links can point to files that are still being written
+                    for future in pending:
+                        future.result()
+                    pending = set()
+                    tar.extract(member, target_path, **EXTRACT_ARGS)
+            for future in pending:
+                future.result()
+
+        # Set the folder permissions last like extractall does, so read only folders can still be written to
+        for member in sorted(directories, key=lambda member: member.name, reverse=True):
+            member_path = os.path.join(target_path, member.name)
+            os.chmod(member_path, member.mode)
+            os.utime(member_path, (member.mtime, member.mtime))
+
+    def write_member_file(self, path, data, member):
+        with open(path, 'wb') as f:
             f.write(data)
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
 
-    def uncompress_tar(self, target_file, target_path):
-        """Uncompress TAR target_file to target_path."""
-        self.logger.debug('Uncompressing TAR to "{}"...'.format(target_path))
-        tar = tarfile.open(target_file)
-        tar.extractall(target_path)
+    def open_tar_stream(self, f):
+        """Open the TAR in an open firmware file positioned after the checksum for sequential reading."""
+        reader = io.BufferedReader(LZMAReader(f, self.chunk_size), buffer_size=self.chunk_size)
+        # Stream mode ('r|') reads the members sequentially so that the whole TAR never needs to be in memory
+        return tarfile.open(fileobj=reader, mode='r|')
 
-    def compress_lzma(self, target):
-        """Compress the contents of target with LZMA compression."""
-        self.logger.debug('Compressing {} with LZMA...'.format(target))
-        with open(target, 'rb') as f:
-            data = f.read()
-        # Getting these LZMA parameters right was a huge pain in the ass. I do not recommend touching them. The OP-1
-        # only accepts max 15mb firwmare files. But using agressive compression requires more ram to decompress.
-        # When using the most agressive preset 9, the OP-1 fails to allocate enough RAM to perform the decompression.
-        # I found that these settings work pretty well. The resulting firmware is under 15mb and it installs fine.
-        lzma_filters = [
-            {'id': lzma.FILTER_LZMA1, 'preset': 9, 'lc': 3, 'lp': 1, 'pb': 2, 'dict_size': 2**23},
-        ]
-        f = lzma.open(target, 'wb', filters=lzma_filters, format=lzma.FORMAT_ALONE)
-        f.write(data)
-        f.close()
+    def compress_stream(self, path, target):
+        """Compress path into the target firmware file with TAR, LZMA and CRC-32 in a single pass."""
+        self.logger.debug('Compressing "{}" to: {}'.format(path, target))
+        with self.open_firmware_writer(target) as tar:
+            self.add_files_to_tar(tar, path)
+
+    @contextmanager
+    def open_firmware_writer(self, target, stage_name='compress_stream'):
+        """Open a TAR for writing that is LZMA compressed into the target firmware file with its checksum."""
+        with open(target, 'wb') as f, op1_stats.stage(stage_name) as info:
+            # Reserve space for the checksum, it's only known once all the data has been compressed
+            f.write(bytes(4))
+            writer = LZMAWriter(f, self.lzma_filters)
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                yield tar
+            writer.finish()
+            info.bytes_in = writer.bytes_in
+            info.bytes_out = writer.bytes_out + 4
+            self.logger.debug('Adding checksum {} to {}'.format(writer.crc, target))
+            f.seek(0)
+            f.write(struct.pack('<L', writer.crc))
 
     def tarinfo_reset(self, tarinfo):
         """Resets user information for each file compressed into the TAR."""
@@ -142,36 +407,148 @@ class OP1Repack:
         tarinfo.uname = tarinfo.gname = 'root'
         return tarinfo
 
-    def compress_tar(self, path, target):
-        """Compresses path into the target TAR file."""
-        self.logger.debug('Repacking to TAR from {} to: {}'.format(path, target))
+    def list_tar_inputs(self, path):
+        """Return (file_path, name) pairs of the top level files and folders that are added to the TAR."""
+        inputs = []
         files = os.listdir(path)
-        tar = tarfile.open(
-            target,
-            'w',
-            format=tarfile.GNU_FORMAT
-        )
         for file in files:
             if file.startswith('.'):
                 continue
             file_path = os.path.join(path, file)
-            self.logger.debug('Adding "{}" to archive.'.format(file_path))
             # Remove the subfolder name so that the archive won't contain the subfolder.
             name = file_path.replace(path+os.sep, '')
+            inputs.append((file_path, name))
+        return inputs
+
+    def add_files_to_tar(self, tar, path):
+        """Add the contents of path to an open TAR archive."""
+        for file_path, name in self.list_tar_inputs(path):
+            self.logger.debug('Adding "{}" to archive.'.format(file_path))
             tar.add(file_path, arcname=name, filter=self.tarinfo_reset)
-        tar.close()
+
+    def tree_digest(self, path):
+        """Calculate a digest of everything that repack would add to the TAR from path.
+
+        The digest covers the sorted member names, types, sizes, permissions and contents.
+        Modification times are ignored so that identical trees unpacked at different times match.
+        """
+        members = []
+        for file_path, name in self.list_tar_inputs(path):
+            members.append((file_path, name))
+            if os.path.isdir(file_path) and not os.path.islink(file_path):
+                for root, dirs, files in os.walk(file_path):
+                    for file in dirs + files:
+                        member_path = os.path.join(root, file)
+                        members.append((member_path, name + member_path[len(file_path):].replace(os.sep, '/')))
+
+        digest = hashlib.sha256()
+        for member_path, name in sorted(members, key=lambda member: member[1]):
+            st = os.lstat(member_path)
+            if stat.S_ISLNK(st.st_mode):
+                content = os.readlink(member_path)
+            elif stat.S_ISREG(st.st_mode):
+                content = self.file_digest(member_path)
+            else:
+                content = ''
+            digest.update('{}\0{:o}\0{}\0{}\n'.format(name, st.st_mode, st.st_size, content).encode('utf-8'))
+        return digest.hexdigest()
+
+    def file_digest(self, path):
+        """Return the SHA-256 hex digest of the contents of a file."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # The separate steps of the whole-file unpacking and repacking that unpack and repack replaced with a single
+    # streaming pass. They're kept for library users and work one chunk at a time like the rest.
+
+    def create_temp_file(self, from_path):
+        """Create a temporary file for the unpacking procedure and return its path."""
+        to_path = from_path + self.temp_file_suffix
+        size = os.path.getsize(from_path)
+        with op1_stats.stage('create_temp_file', bytes_in=size, bytes_out=size):
+            shutil.copy(from_path, to_path)
+        return to_path
+
+    @contextmanager
+    def rewrite_file(self, path):
+        """Open a temporary file that replaces the file at path when the with block succeeds."""
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                yield f
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def remove_crc(self, path):
+        """Remove the first 4 bytes of the firmware which contain the CRC-32 checksum."""
+        with op1_stats.stage('remove_crc') as info:
+            with self.rewrite_file(path) as f, open(path, 'rb') as source:
+                self.read_crc(source)
+                shutil.copyfileobj(source, f, self.chunk_size)
+                info.bytes_out = f.tell()
+            info.bytes_in = info.bytes_out + 4
+
+    def add_crc(self, path):
+        """Generates and adds a CRC to the beginning of a file."""
+        with op1_stats.stage('add_crc') as info:
+            with self.rewrite_file(path) as f, open(path, 'rb') as source:
+                checksum = self.calculate_crc(source)
+                self.logger.debug('Adding checksum {} to {}'.format(checksum, path))
+                f.write(struct.pack('<L', checksum))
+                source.seek(0)
+                shutil.copyfileobj(source, f, self.chunk_size)
+                info.bytes_out = f.tell()
+            info.bytes_in = info.bytes_out - 4
+
+    def uncompress_lzma(self, target_file, target_path):
+        """Uncompress LZMA target_file contents to target_path."""
+        self.logger.debug('Uncompressing LZMA...')
+        with op1_stats.stage('uncompress_lzma', bytes_in=os.path.getsize(target_file)) as info:
+            with open(target_file, 'rb') as source, open(target_path, 'wb') as f:
+                shutil.copyfileobj(io.BufferedReader(LZMAReader(source, self.chunk_size)), f, self.chunk_size)
+                info.bytes_out = f.tell()
+
+    def uncompress_tar(self, target_file, target_path):
+        """Uncompress TAR target_file to target_path."""
+        self.logger.debug('Uncompressing TAR to "{}"...'.format(target_path))
+        with op1_stats.stage('uncompress_tar', bytes_in=os.path.getsize(target_file)):
+            with tarfile.open(target_file) as tar:
+                self.extract_tar(tar, target_path)
+
+    def compress_lzma(self, target):
+        """Compress the contents of target with LZMA compression."""
+        self.logger.debug('Compressing {} with LZMA...'.format(target))
+        with op1_stats.stage('compress_lzma') as info:
+            with self.rewrite_file(target) as f, open(target, 'rb') as source:
+                writer = LZMAWriter(f, self.lzma_filters)
+                shutil.copyfileobj(source, writer, self.chunk_size)
+                writer.finish()
+            info.bytes_in = writer.bytes_in
+            info.bytes_out = writer.bytes_out
+
+    def compress_tar(self, path, target):
+        """Compresses path into the target TAR file."""
+        self.logger.debug('Repacking to TAR from {} to: {}'.format(path, target))
+        with op1_stats.stage('compress_tar') as info:
+            with tarfile.open(target, 'w', format=tarfile.GNU_FORMAT) as tar:
+                self.add_files_to_tar(tar, path)
+            info.bytes_out = os.path.getsize(target)
 
     def set_permissions(self, target):
         """Make the unpacked firmware folder readable."""
-        # TODO: does this need to be done on Windows?
         self.logger.debug('Setting access permissions to "{}" ...'.format(target))
-        self.add_dir_permissions(target, stat.S_IEXEC)
+        with op1_stats.stage('set_permissions'):
+            self.add_dir_permissions(target, stat.S_IEXEC)
 
     def add_dir_permissions(self, target, flag):
-        """Recursively adds 'flag' permission to all subfolders in target."""
+        """Adds 'flag' permission to all subfolders in target."""
         for root, dirs, files in os.walk(target):
             for directory in dirs:
                 path = os.path.join(root, directory)
                 st = os.stat(path)
                 os.chmod(path, st.st_mode | flag)
-                self.add_dir_permissions(path, flag)
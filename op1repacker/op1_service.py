@@ -0,0 +1,372 @@
+"""A local build service that builds modified firmware from base firmware files on request.
+
+The service is used over HTTP on a Unix socket or a localhost port:
+
+    POST /jobs           queue a job: {"firmware": "/path/op1_235.op1", "options": ["iter"], "profile": null}
+    POST /jobs?wait=1    queue a job and answer when it's finished
+    GET /jobs            list the jobs
+    GET /jobs/<id>       status, path of the built firmware, output and stages of a job
+    DELETE /jobs/<id>    remove a finished job and its firmware file
+
+Each base firmware is unpacked once and kept in the service directory, so a job only creates a workspace of the
+unpacked files (see op1_workspace), applies the mods and repacks them. Repacking uses the repack cache, so identical
+builds are instant. The jobs run in a pool of worker processes and the stages of each job are recorded like with
+--stats.
+
+The service has no authentication. Anyone who can connect to it can build any firmware file the service can read,
+so a Unix socket is safer on shared machines. To keep web pages from using the service on a port, jobs must be
+submitted as application/json and requests from other origins or for other host names are refused.
+"""
+
+import io
+import os
+import json
+import stat
+import time
+import uuid
+import shutil
+import socket
+import threading
+import socketserver
+import multiprocessing
+from contextlib import redirect_stdout
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import op1_cache
+from . import op1_stats
+
+DEFAULT_SERVICE_PATH = os.path.join(op1_cache.CACHE_ROOT, 'service')
+DEFAULT_PORT = 8901
+REPACK_FILE_SUFFIX = '-repacked.op1'
+
+
+def unpack_base(firmware_path, base_path):
+    """Unpack a base firmware in a worker process. Returns (success, stages, output)."""
+    from . import op1_repack
+    recorder = op1_stats.StatsRecorder()
+    output = io.StringIO()
+    temp_path = base_path + '.unpacking'
+    with redirect_stdout(output), op1_stats.recording(recorder):
+        shutil.rmtree(temp_path, ignore_errors=True)
+        success = op1_repack.OP1Repack().unpack(firmware_path, target_path=temp_path)
+        if success:
+            # The base is only used once it's complete
+            os.rename(temp_path, base_path)
+        else:
+            shutil.rmtree(temp_path, ignore_errors=True)
+    return success, recorder.stages, output.getvalue()
+
+
+def build(base_path, workspace_path, options, lzma_filters=None):
+    """Build modified firmware from an unpacked base firmware in a worker process. Returns (success, stages, output).
+
+    The firmware is saved next to the workspace, which is removed afterwards.
+    """
+    from . import op1_mods
+    from . import op1_repack
+    from . import op1_workspace
+    recorder = op1_stats.StatsRecorder()
+    output = io.StringIO()
+    with redirect_stdout(output), op1_stats.recording(recorder):
+        try:
+            with op1_stats.stage('workspace'):
+                op1_workspace.create_workspace(base_path, workspace_path)
+            success = op1_mods.modify(workspace_path, options)
+            if success:
+                repacker = op1_repack.OP1Repack()
+                if lzma_filters:
+                    repacker.lzma_filters = lzma_filters
+                success = repacker.repack(workspace_path, cache=op1_cache.RepackCache())
+        finally:
+            shutil.rmtree(workspace_path, ignore_errors=True)
+    return success, recorder.stages, output.getvalue()
+
+
+class BuildService:
+    """Queues build jobs, runs them on a pool of worker processes and keeps the unpacked base firmware."""
+
+    def __init__(self, path=DEFAULT_SERVICE_PATH, workers=None):
+        self.path = path
+        self.bases_path = os.path.join(path, 'bases')
+        self.jobs_path = os.path.join(path, 'jobs')
+        os.makedirs(self.bases_path, exist_ok=True)
+        os.makedirs(self.jobs_path, exist_ok=True)
+        workers = workers or os.cpu_count() or 1
+        # The service runs in threads, so the worker processes are spawned instead of forked
+        self.processes = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        # A thread per running job waits for the worker processes, the other jobs wait in the queue of the pool
+        self.threads = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.base_locks = {}
+        self.jobs = {}
+        self.futures = {}
+
+    def submit(self, firmware, options=None, profile=None):
+        """Queue a build job and return its id. Raises ValueError if the job is invalid."""
+        from . import op1_mods
+        from . import op1_tune
+        if not isinstance(firmware, str) or not os.path.isfile(firmware):
+            raise ValueError('Firmware file doesn\'t exist: {}'.format(firmware))
+        options = options or []
+        if not isinstance(options, list) or not all(isinstance(option, str) for option in options):
+            raise ValueError('The options must be a list of mod names')
+        try:
+            op1_mods.selected_mods(options)
+        except KeyError as e:
+            raise ValueError(e.args[0])
+        lzma_filters = None
+        if profile is not None:
+            try:
+                lzma_filters = op1_tune.load_profile(profile)
+            except (OSError, TypeError, KeyError, IndexError) as e:
+                raise ValueError('Failed to load LZMA profile {}: {}'.format(profile, e))
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'firmware': os.path.abspath(firmware),
+            'options': options,
+            'profile': profile,
+            'artifact': None,
+            'error': None,
+            'output': '',
+            'queue_time': None,
+            'build_time': None,
+            'stages': [],
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+            self.futures[job['id']] = self.threads.submit(self.run, job, lzma_filters, time.perf_counter())
+        return job['id']
+
+    def update(self, job, **fields):
+        with self.lock:
+            job.update(fields)
+
+    def get(self, job_id):
+        """Return a copy of a job, or None if there's no such job."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def wait(self, job_id):
+        """Wait for a job to finish and return it."""
+        with self.lock:
+            future = self.futures.get(job_id)
+        if future is not None:
+            future.result()
+        return self.get(job_id)
+
+    def delete(self, job_id):
+        """Remove a finished job and its files. Returns False if there's no such job.
+
+        Raises ValueError if the job hasn't finished.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if job['status'] not in ('done', 'failed'):
+                raise ValueError('Job {} hasn\'t finished yet'.format(job_id))
+            del self.jobs[job_id]
+            del self.futures[job_id]
+        shutil.rmtree(os.path.join(self.jobs_path, job_id), ignore_errors=True)
+        return True
+
+    def base_tree(self, firmware_path):
+        """Return the path of the unpacked base firmware and the stages and output of unpacking it.
+
+        Every base firmware is unpacked only once, jobs that need it meanwhile wait for it.
+        """
+        from . import op1_manifest
+        with op1_stats.stage('base_digest', bytes_in=os.path.getsize(firmware_path)):
+            digest = op1_manifest.hash_file(firmware_path)
+        base_path = os.path.join(self.bases_path, digest)
+        with self.lock:
+            base_lock = self.base_locks.setdefault(digest, threading.Lock())
+        with base_lock:
+            if os.path.isdir(base_path):
+                return base_path, [], ''
+            success, stages, output = self.processes.submit(unpack_base, firmware_path, base_path).result()
+        if not success:
+            raise ValueError('Failed to unpack the base firmware: {}'.format(firmware_path))
+        return base_path, stages, output
+
+    def run(self, job, lzma_filters, queued):
+        start = time.perf_counter()
+        self.update(job, status='running', queue_time=start - queued)
+        recorder = op1_stats.StatsRecorder()
+        stages = []
+        output = ''
+        result = {'status': 'failed'}
+        try:
+            with op1_stats.recording(recorder):
+                base_path, stages, output = self.base_tree(job['firmware'])
+            stages = recorder.stages + stages
+            job_path = os.path.join(self.jobs_path, job['id'])
+            os.makedirs(job_path, exist_ok=True)
+            workspace_path = os.path.join(job_path, os.path.splitext(os.path.basename(job['firmware']))[0])
+            success, build_stages, build_output = self.processes.submit(
+                build, base_path, workspace_path, job['options'], lzma_filters).result()
+            stages += build_stages
+            output += build_output
+            if success:
+                result = {'status': 'done', 'artifact': workspace_path + REPACK_FILE_SUFFIX}
+            else:
+                result['error'] = 'Errors occured during the build'
+        except Exception as e:
+            stages = stages or recorder.stages
+            result['error'] = str(e) or type(e).__name__
+        # The job is updated at once, so a finished job always has its stages
+        self.update(job, stages=stages, output=output, build_time=time.perf_counter() - start, **result)
+        print('Job {} {}: {}'.format(job['id'], job['status'], job['artifact'] or job['error']), flush=True)
+
+    def shutdown(self):
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        self.processes.shutdown(wait=True, cancel_futures=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    server_version = 'op1repacker'
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def send_json(self, status, data):
+        body = json.dumps(data, indent=4).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def refused(self):
+        """Send an error and return True if the request may come from a web page or a DNS rebinding attack."""
+        allowed_hosts = self.server.allowed_hosts
+        host = self.headers.get('Host')
+        if allowed_hosts is not None and host not in allowed_hosts:
+            self.send_json(403, {'error': 'Requests for host {} are refused'.format(host)})
+            return True
+        origin = self.headers.get('Origin')
+        if origin is not None and (allowed_hosts is None or origin not in ['http://' + h for h in allowed_hosts]):
+            self.send_json(403, {'error': 'Requests from other origins are refused'})
+            return True
+        return False
+
+    def job_id(self, path):
+        """Return the job id of a /jobs/<id> path, or None."""
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        if self.refused():
+            return
+        path = urlsplit(self.path).path
+        if path.rstrip('/') == '/jobs':
+            self.send_json(200, self.server.service.list_jobs())
+            return
+        job = self.server.service.get(self.job_id(path))
+        if job is None:
+            self.send_json(404, {'error': 'No such job'})
+            return
+        self.send_json(200, job)
+
+    def do_POST(self):
+        if self.refused():
+            return
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'Jobs are submitted to /jobs'})
+            return
+        # Web pages can only send other types without asking the service first
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'error': 'Jobs must be submitted as application/json'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('The job must be a JSON object')
+            job_id = self.server.service.submit(request.get('firmware'), request.get('options'),
+                                                request.get('profile'))
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        wait = parse_qs(url.query).get('wait', ['0'])[0]
+        if wait not in ('', '0', 'false'):
+            self.send_json(200, self.server.service.wait(job_id))
+            return
+        self.send_json(202, self.server.service.get(job_id))
+
+    def do_DELETE(self):
+        if self.refused():
+            return
+        try:
+            deleted = self.server.service.delete(self.job_id(urlsplit(self.path).path))
+        except ValueError as e:
+            self.send_json(409, {'error': str(e)})
+            return
+        if not deleted:
+            self.send_json(404, {'error': 'No such job'})
+            return
+        self.send_json(200, {'deleted': True})
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = getattr(socket, 'AF_UNIX', None)
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a host and a port
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def create_server(service, socket_path=None, port=DEFAULT_PORT):
+    """Create an HTTP server for the service on a Unix socket if socket_path is given, otherwise on localhost."""
+    if socket_path:
+        if UnixHTTPServer.address_family is None:
+            raise ValueError('Unix sockets aren\'t supported on this platform, use a port instead')
+        # Remove the socket left behind by an earlier service, but nothing else
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        # Web pages can't connect to a Unix socket, so any host name is fine
+        server.allowed_hosts = None
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), ServiceHandler)
+        server.allowed_hosts = ['127.0.0.1:{}'.format(server.server_port), 'localhost:{}'.format(server.server_port)]
+    server.service = service
+    return server
+
+
+def serve(socket_path=None, port=DEFAULT_PORT, path=DEFAULT_SERVICE_PATH, workers=None):
+    """Run the build service until it's interrupted."""
+    service = BuildService(path, workers)
+    try:
+        server = create_server(service, socket_path, port)
+    except (OSError, ValueError):
+        service.shutdown()
+        raise
+    if socket_path:
+        print('Serving builds on {}'.format(socket_path))
+    else:
+        print('Serving builds on http://127.0.0.1:{}/'.format(server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping...')
+    finally:
+        server.server_close()
+        service.shutdown()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
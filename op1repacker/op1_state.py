@@ -0,0 +1,116 @@
+"""Keep track of the mods applied to unpacked firmware.
+
+The state is saved to a file at the top of the unpacked firmware. Top level dotfiles aren't added to repacked
+firmware, so it never ends up on the OP-1. The state has the version of each applied mod and the hash of each file
+the mods changed as it was after the last modify. Files are only hashed again if their size or modification time
+changed, so checking which mods are applied doesn't need to read anything in the common case.
+"""
+
+import os
+import json
+
+from . import op1_manifest
+
+STATE_FILE = '.op1repacker-state.json'
+STATE_VERSION = 1
+
+
+def state_path(tree_path):
+    return os.path.join(tree_path, STATE_FILE)
+
+
+class ModState:
+    """The mods applied to an unpacked firmware directory. A missing or unreadable state file means no mods."""
+
+    def __init__(self, tree_path):
+        self.tree_path = tree_path
+        self.mods = {}
+        self.files = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(state_path(self.tree_path)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get('version') != STATE_VERSION:
+            return
+        self.mods = data.get('mods', {})
+        self.files = data.get('files', {})
+
+    def save(self):
+        path = state_path(self.tree_path)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'mods': self.mods, 'files': self.files}, f, indent=1,
+                      sort_keys=True)
+        os.replace(temp_path, path)
+        self.changed = False
+
+    def member_path(self, member):
+        return os.path.join(self.tree_path, *member.split('/'))
+
+    def file_unchanged(self, member):
+        """Return True if a file has the contents it had when the state was saved."""
+        saved = self.files.get(member)
+        if saved is None:
+            return False
+        path = self.member_path(member)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != saved['size']:
+            return False
+        if st.st_mtime_ns == saved['mtime']:
+            return True
+        if op1_manifest.hash_file(path) != saved['sha256']:
+            return False
+        # Same contents, skip hashing the file next time
+        saved['mtime'] = st.st_mtime_ns
+        self.changed = True
+        return True
+
+    def changed_mods(self):
+        """Return the names of the applied mods whose files were changed by something else since."""
+        changed_members = {member for mod in self.mods.values() for member in mod['members']
+                           if not self.file_unchanged(member)}
+        return [name for name, mod in self.mods.items() if changed_members.intersection(mod['members'])]
+
+    def forget(self, names):
+        """Forget that mods were applied, e.g. because their files changed."""
+        for name in names:
+            del self.mods[name]
+        if names:
+            self.changed = True
+
+    def applied(self, mod):
+        """Return True if the same version of a mod has been applied. Forget the changed mods first."""
+        saved = self.mods.get(mod.name)
+        return saved is not None and saved['version'] == mod.version
+
+    def update_file(self, member):
+        path = self.member_path(member)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.files.pop(member, None)
+            return
+        saved = self.files.get(member)
+        if saved and saved['size'] == st.st_size and saved['mtime'] == st.st_mtime_ns:
+            return
+        self.files[member] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': op1_manifest.hash_file(path)}
+
+    def record(self, mods):
+        """Record that mods were applied and save the current hashes of the files changed by the applied mods.
+
+        The files are only changed by modify between checking the changed mods and record, so the mods applied
+        earlier are still applied.
+        """
+        for mod in mods:
+            self.mods[mod.name] = {'version': mod.version, 'members': mod.members}
+        for member in sorted({member for mod in self.mods.values() for member in mod['members']}):
+            self.update_file(member)
+        self.changed = True
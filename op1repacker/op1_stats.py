@@ -0,0 +1,112 @@
+"""Record the time, data sizes and memory use of each firmware processing stage.
+
+Library users can collect the stages of their own calls:
+
+    recorder = op1_stats.StatsRecorder(callback=print)
+    with op1_stats.recording(recorder):
+        op1_repack.OP1Repack().unpack('op1_235.op1')
+    recorder.save('stats.json')
+
+Stages are only measured while a recorder is active, otherwise they cost nothing extra.
+
+The peak_rss of a record is the peak memory use of the whole process up to the end of the stage, not of the stage
+alone. The operating system only keeps the peak of the process, so a stage that uses less memory than an earlier one
+reports the peak of the earlier one.
+"""
+
+import sys
+import json
+import time
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+current_recorder = contextvars.ContextVar('op1_stats_recorder', default=None)
+
+
+def peak_rss():
+    """Return the peak resident set size of the process since it started in bytes, or None if it's unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StatsRecorder:
+    """Collects the records of the stages run while it's active. callback is called with each new record."""
+
+    def __init__(self, callback=None):
+        self.stages = []
+        self.callback = callback
+
+    def add(self, record):
+        self.stages.append(record)
+        if self.callback:
+            self.callback(record)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=4)
+
+
+class Stage:
+    """A running stage. The byte counts can be set while the stage runs if they're not known up front."""
+
+    def __init__(self, name, bytes_in=None, bytes_out=None):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+
+@contextmanager
+def recording(recorder):
+    """Record the stages run inside the with block to recorder."""
+    token = current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        current_recorder.reset(token)
+
+
+def add_stage(name, wall_time, cpu_time, bytes_in=None, bytes_out=None):
+    """Record a stage measured elsewhere, e.g. in another process, if a recorder is active."""
+    recorder = current_recorder.get()
+    if recorder is None:
+        return
+    recorder.add({
+        'stage': name,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'peak_rss': peak_rss(),
+    })
+
+
+@contextmanager
+def stage(name, bytes_in=None, bytes_out=None):
+    """Measure the code inside the with block as a stage if a recorder is active."""
+    info = Stage(name, bytes_in, bytes_out)
+    recorder = current_recorder.get()
+    if recorder is None:
+        yield info
+        return
+
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield info
+    finally:
+        recorder.add({
+            'stage': info.name,
+            'wall_time': time.perf_counter() - start_wall,
+            'cpu_time': time.process_time() - start_cpu,
+            'bytes_in': info.bytes_in,
+            'bytes_out': info.bytes_out,
+            'peak_rss': peak_rss(),
+        })
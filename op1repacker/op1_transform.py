@@ -0,0 +1,329 @@
+"""Affine transforms of SVG geometry for the transform change of GFX patches.
+
+The coordinates of all the transformed elements are collected first and transformed together with NumPy. NumPy is
+only needed for patches that use transform: pip install op1repacker[transform]
+"""
+
+import re
+
+ELEMENT = re.compile(r'<(rect|line|circle|ellipse|polyline|polygon|path)\s[^>]*>')
+ATTRIBUTE = re.compile(r'(\s)([\w:-]+)="([^"]*)"')
+NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+NUMBERS = re.compile(NUMBER)
+PATH_TOKEN = re.compile(r'([MmLlHhVvCcSsQqTtAaZz])|(' + NUMBER + ')')
+# Number of arguments of each path command
+PATH_ARGS = {'M': 2, 'L': 2, 'T': 2, 'C': 6, 'S': 4, 'Q': 4, 'H': 1, 'V': 1, 'A': 7, 'Z': 0}
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('The transform change of GFX patches needs NumPy: pip install op1repacker[transform]')
+    return numpy
+
+
+def format_coordinate(value):
+    # Rounded like the coordinates moved by op1_gfx, and without negative zeros
+    return str(round(value, 4) + 0.0)
+
+
+def is_axis_aligned(matrix):
+    a, b, c, d, e, f = matrix
+    return b == 0 and c == 0
+
+
+def is_similarity(matrix):
+    """Check if the matrix only rotates, mirrors, scales uniformly and translates, so circles stay circles."""
+    a, b, c, d, e, f = matrix
+    return abs(a * a + b * b - c * c - d * d) < 1e-9 and abs(a * c + b * d) < 1e-9
+
+
+def check_matrix(matrix):
+    """Return the matrix as 6 floats in the order of the SVG matrix() transform. Raises ValueError if invalid."""
+    try:
+        matrix = [float(value) for value in matrix]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid transform matrix: {}'.format(matrix))
+    if len(matrix) != 6:
+        raise ValueError('A transform matrix needs 6 values [a, b, c, d, e, f], got {}'.format(len(matrix)))
+    return matrix
+
+
+def parse_path(path_data):
+    """Split path data into a list of (command, numbers), repeated arguments are split into their own commands."""
+    commands = []
+    command = None
+    numbers = []
+    for letter, number in PATH_TOKEN.findall(path_data) + [('', None)]:
+        if number:
+            if command is None:
+                raise ValueError('Invalid path data: {}'.format(path_data))
+            numbers.append(float(number))
+            continue
+        if command is not None:
+            count = PATH_ARGS[command.upper()]
+            if (count == 0 and numbers) or (count and (not numbers or len(numbers) % count)):
+                raise ValueError('Invalid path data: {}'.format(path_data))
+            commands.append((command, numbers[:count]))
+            # Points after the first one of a move are lines
+            repeated = {'M': 'L', 'm': 'l'}.get(command, command)
+            commands.extend((repeated, numbers[i:i + count]) for i in range(count, len(numbers), count or 1))
+        command = letter or None
+        numbers = []
+    return commands
+
+
+class Batch:
+    """Coordinates of many elements collected to be transformed at once."""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        # Absolute coordinates get the whole transform, relative ones aren't translated
+        self.coordinates = {False: [], True: []}
+        self.ellipses = []
+        self.results = None
+        self.ellipse_results = None
+
+    def point(self, x, y, relative=False):
+        coordinates = self.coordinates[relative]
+        coordinates.append((x, y))
+        return relative, len(coordinates) - 1
+
+    def ellipse(self, rx, ry, angle):
+        self.ellipses.append((rx, ry, angle))
+        return len(self.ellipses) - 1
+
+    def transform(self):
+        numpy = import_numpy()
+        a, b, c, d, e, f = self.matrix
+        linear = numpy.array([[a, c], [b, d]])
+        self.results = {}
+        for relative, coordinates in self.coordinates.items():
+            result = numpy.array(coordinates, dtype=float).reshape(-1, 2) @ linear.T
+            if not relative:
+                result += (e, f)
+            self.results[relative] = result.tolist()
+        self.ellipse_results = self.transform_ellipses(numpy, linear)
+
+    def transform_ellipses(self, numpy, linear):
+        """Return the radii and rotation of the arc ellipses after the transform."""
+        if not self.ellipses:
+            return []
+        ellipses = numpy.array(self.ellipses, dtype=float)
+        rx, ry, angle = ellipses.T
+        theta = numpy.radians(angle)
+        cos, sin = numpy.cos(theta), numpy.sin(theta)
+        # The ellipse is the unit circle transformed by rotation(angle) @ scale(rx, ry) and then the matrix
+        shape = numpy.stack([numpy.stack([cos * rx, -sin * ry], -1), numpy.stack([sin * rx, cos * ry], -1)], -2)
+        u, s, _ = numpy.linalg.svd(linear @ shape)
+        new_angle = numpy.degrees(numpy.arctan2(u[:, 1, 0], u[:, 0, 0]))
+        results = numpy.stack([s[:, 0], s[:, 1], new_angle], -1)
+
+        if is_axis_aligned(self.matrix):
+            # Keep the radii in their order when the axes of unrotated ellipses stay where they are
+            unrotated = angle % 180 == 0
+            aligned = numpy.stack([rx * abs(linear[0, 0]), ry * abs(linear[1, 1]), angle], -1)
+            results[unrotated] = aligned[unrotated]
+        return results.tolist()
+
+    def get(self, key):
+        relative, index = key
+        return self.results[relative][index]
+
+    def format_point(self, key):
+        return '{},{}'.format(*[format_coordinate(value) for value in self.get(key)])
+
+
+def element_attributes(element):
+    return {name: value for _, name, value in ATTRIBUTE.findall(element)}
+
+
+def set_attributes(element, values):
+    """Set the values of attributes of an element tag, attributes it doesn't have yet are added at the end."""
+    def replace(pat):
+        name = pat.group(2)
+        if name not in values:
+            return pat.group(0)
+        return '{}{}="{}"'.format(pat.group(1), name, values.pop(name))
+
+    values = dict(values)
+    element = ATTRIBUTE.sub(replace, element)
+    if values:
+        end = len(element) - (2 if element.endswith('/>') else 1)
+        added = ''.join(' {}="{}"'.format(name, value) for name, value in values.items())
+        element = element[:end].rstrip() + added + element[end:]
+    return element
+
+
+def number(attributes, name):
+    try:
+        return float(attributes.get(name, 0))
+    except ValueError:
+        raise ValueError('Invalid number in {}="{}"'.format(name, attributes[name]))
+
+
+def collect_line(batch, attributes):
+    start = batch.point(number(attributes, 'x1'), number(attributes, 'y1'))
+    end = batch.point(number(attributes, 'x2'), number(attributes, 'y2'))
+
+    def write():
+        (x1, y1), (x2, y2) = batch.get(start), batch.get(end)
+        return {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}
+    return write
+
+
+def collect_circle(batch, attributes):
+    if not is_similarity(batch.matrix):
+        raise ValueError('Circles can only be rotated, mirrored or scaled uniformly')
+    center = batch.point(number(attributes, 'cx'), number(attributes, 'cy'))
+    a, b, c, d, e, f = batch.matrix
+    radius = number(attributes, 'r') * (a * a + b * b) ** 0.5
+
+    def write():
+        cx, cy = batch.get(center)
+        return {'cx': cx, 'cy': cy, 'r': radius}
+    return write
+
+
+def collect_ellipse(batch, attributes):
+    if not is_axis_aligned(batch.matrix):
+        raise ValueError('Ellipse elements can only be mirrored or scaled, use a path to rotate them')
+    center = batch.point(number(attributes, 'cx'), number(attributes, 'cy'))
+    a, b, c, d, e, f = batch.matrix
+    radii = {'rx': number(attributes, 'rx') * abs(a), 'ry': number(attributes, 'ry') * abs(d)}
+
+    def write():
+        cx, cy = batch.get(center)
+        return dict(radii, cx=cx, cy=cy)
+    return write
+
+
+def collect_rect(batch, attributes):
+    if not is_axis_aligned(batch.matrix):
+        raise ValueError('Rect elements can only be mirrored or scaled, use a path to rotate them')
+    x, y = number(attributes, 'x'), number(attributes, 'y')
+    corner = batch.point(x, y)
+    opposite = batch.point(x + number(attributes, 'width'), y + number(attributes, 'height'))
+    a, b, c, d, e, f = batch.matrix
+    # Rounded corners are scaled with the rect
+    radii = {name: number(attributes, name) * abs(scale) for name, scale in (('rx', a), ('ry', d))
+             if name in attributes}
+
+    def write():
+        (x1, y1), (x2, y2) = batch.get(corner), batch.get(opposite)
+        # Mirroring swaps the corners
+        return dict(radii, x=min(x1, x2), y=min(y1, y2), width=abs(x2 - x1), height=abs(y2 - y1))
+    return write
+
+
+def collect_polyline(batch, attributes):
+    numbers = [float(value) for value in NUMBERS.findall(attributes.get('points', ''))]
+    if len(numbers) % 2:
+        raise ValueError('Invalid points: {}'.format(attributes['points']))
+    points = [batch.point(x, y) for x, y in zip(numbers[::2], numbers[1::2])]
+
+    def write():
+        return {'points': ' '.join(batch.format_point(point) for point in points)}
+    return write
+
+
+def collect_path(batch, attributes):
+    axis_aligned = is_axis_aligned(batch.matrix)
+    segments = []
+    current = start = (0.0, 0.0)
+    for command, args in parse_path(attributes.get('d', '')):
+        name = command.upper()
+        # The first move is always absolute, even when it's written as a relative one
+        relative = command != name and bool(segments)
+        if name in ('H', 'V'):
+            if relative:
+                args = [args[0], 0.0] if name == 'H' else [0.0, args[0]]
+            else:
+                args = [args[0], current[1]] if name == 'H' else [current[0], args[0]]
+            if not axis_aligned:
+                # Horizontal and vertical lines don't stay horizontal or vertical
+                name = 'L'
+                command = 'l' if relative else 'L'
+
+        if name == 'Z':
+            segments.append((command, []))
+            current = start
+            continue
+        if name == 'A':
+            ellipse = batch.ellipse(*args[:3])
+            point = batch.point(args[5], args[6], relative)
+            segments.append((command, [('ellipse', ellipse), ('flags', args[3:5]), ('point', point)]))
+        else:
+            points = [batch.point(args[i], args[i + 1], relative) for i in range(0, len(args), 2)]
+            segments.append((command, [(name if name in ('H', 'V') else 'point', point) for point in points]))
+
+        end = (args[-2], args[-1])
+        current = (current[0] + end[0], current[1] + end[1]) if relative else end
+        if name == 'M':
+            start = current
+
+    def write():
+        # Arcs sweep the other way around when the transform mirrors them
+        a, b, c, d, e, f = batch.matrix
+        mirrored = a * d - b * c < 0
+        parts = []
+        for command, items in segments:
+            values = []
+            for kind, item in items:
+                if kind == 'point':
+                    values.append(batch.format_point(item))
+                elif kind in ('H', 'V'):
+                    values.append(format_coordinate(batch.get(item)[kind == 'V']))
+                elif kind == 'ellipse':
+                    rx, ry, angle = batch.ellipse_results[item]
+                    values.append('{},{} {}'.format(format_coordinate(rx), format_coordinate(ry),
+                                                    format_coordinate(angle)))
+                else:
+                    large, sweep = int(item[0]), int(item[1])
+                    values.append('{},{}'.format(large, 1 - sweep if mirrored else sweep))
+            parts.append(command + ' '.join(values))
+        return {'d': ' '.join(parts)}
+    return write
+
+
+COLLECTORS = {
+    'line': collect_line,
+    'circle': collect_circle,
+    'ellipse': collect_ellipse,
+    'rect': collect_rect,
+    'polyline': collect_polyline,
+    'polygon': collect_polyline,
+    'path': collect_path,
+}
+
+
+def transform_texts(texts, matrix):
+    """Apply an affine transform to the geometry of every element in the given pieces of SVG data.
+
+    The matrix is given as [a, b, c, d, e, f] like the SVG matrix() transform. The coordinates of all the
+    elements are transformed in one go. Raises ValueError for elements that can't be transformed.
+    """
+    batch = Batch(check_matrix(matrix))
+    writers = []
+    for text_index, text in enumerate(texts):
+        for match in ELEMENT.finditer(text):
+            writer = COLLECTORS[match.group(1)](batch, element_attributes(match.group(0)))
+            writers.append((text_index, match.start(), match.end(), writer))
+    if not writers:
+        return list(texts)
+
+    batch.transform()
+    parts = [[] for _ in texts]
+    positions = [0] * len(texts)
+    for text_index, start, end, writer in writers:
+        text = texts[text_index]
+        values = {name: value if isinstance(value, str) else format_coordinate(value)
+                  for name, value in writer().items()}
+        parts[text_index].extend([text[positions[text_index]:start], set_attributes(text[start:end], values)])
+        positions[text_index] = end
+    return [''.join(text_parts) + text[position:] for text_parts, text, position in zip(parts, texts, positions)]
+
+
+def transform_svg(data, matrix):
+    return transform_texts([data], matrix)[0]
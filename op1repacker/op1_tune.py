@@ -0,0 +1,168 @@
+"""Search for LZMA settings that keep repacked firmware within the limits of the OP-1."""
+
+import os
+import lzma
+import json
+import time
+import tarfile
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# The OP-1 only accepts firmware files up to 15mb
+MAX_FIRMWARE_SIZE = 15 * 1024 * 1024
+# Bigger dictionaries need more RAM than the OP-1 has available for decompressing the firmware
+MAX_DICT_SIZE = 2**23
+# The decoder memory needed by the known good default settings (lc=3, lp=1, dict_size=2**23)
+MAX_DECODER_MEMORY = MAX_DICT_SIZE + (1846 + (0x300 << 4)) * 2
+
+# The dictionary size is set for every candidate, so the presets would only differ by the settings below. Presets
+# 6-9 for example differ only by the dictionary size and would all give the same result.
+ENCODER_SETTINGS = [  # (mode, mf, nice_len, depth), a depth of 0 lets liblzma choose it
+    ('fast', 'hc4', 32, 0),
+    ('normal', 'hc4', 64, 0),
+    ('normal', 'bt4', 32, 0),
+    ('normal', 'bt4', 64, 0),
+    ('normal', 'bt4', 273, 0),
+    ('normal', 'bt4', 273, 512),
+]
+MODES = {'fast': lzma.MODE_FAST, 'normal': lzma.MODE_NORMAL}
+MATCH_FINDERS = {'hc3': lzma.MF_HC3, 'hc4': lzma.MF_HC4, 'bt2': lzma.MF_BT2, 'bt3': lzma.MF_BT3, 'bt4': lzma.MF_BT4}
+LITERAL_SETTINGS = [  # (lc, lp, pb)
+    (3, 0, 2),
+    (3, 1, 2),
+    (2, 2, 2),
+    (0, 2, 2),
+]
+DICT_SIZES = [2**21, 2**22, 2**23]
+# Timing candidates while the others run in parallel is only good for picking the finalists. The finalists are
+# timed one at a time, the best of TIMING_REPEATS runs counts.
+FINALISTS = 4
+TIMING_REPEATS = 2
+
+CHUNK_SIZE = 2**20
+PROFILE_SUFFIX = '.profile.json'
+
+
+def decoder_memory(filters):
+    """Estimate the memory needed to decompress LZMA1 data: the dictionary and the probability tables."""
+    return filters['dict_size'] + (1846 + (0x300 << (filters['lc'] + filters['lp']))) * 2
+
+
+def candidate_grid():
+    """Return every combination of settings to try, with the dictionary size capped at MAX_DICT_SIZE."""
+    candidates = []
+    for (mode, mf, nice_len, depth), (lc, lp, pb), dict_size in itertools.product(
+            ENCODER_SETTINGS, LITERAL_SETTINGS, DICT_SIZES):
+        candidates.append({
+            'mode': mode,
+            'mf': mf,
+            'nice_len': nice_len,
+            'depth': depth,
+            'lc': lc,
+            'lp': lp,
+            'pb': pb,
+            'dict_size': min(dict_size, MAX_DICT_SIZE),
+        })
+    return candidates
+
+
+def filters_from_settings(settings):
+    """Return the LZMA filters of settings. The mode and match finder are saved by name to keep profiles readable."""
+    filters = dict(settings, id=lzma.FILTER_LZMA1)
+    if 'mode' in filters:
+        filters['mode'] = MODES[filters['mode']]
+    if 'mf' in filters:
+        filters['mf'] = MATCH_FINDERS[filters['mf']]
+    return [filters]
+
+
+def compress_candidate(tar_path, settings):
+    """Compress the TAR file with the given settings and return the compressed size and the time it took."""
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE, filters=filters_from_settings(settings))
+    # The firmware starts with a 4 byte checksum
+    size = 4
+    start_time = time.perf_counter()
+    with open(tar_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            size += len(compressor.compress(chunk))
+    size += len(compressor.flush())
+    return size, time.perf_counter() - start_time
+
+
+def try_candidate(tar_path, settings):
+    """Compress the TAR file with the given settings and return the results."""
+    size, elapsed = compress_candidate(tar_path, settings)
+    memory = decoder_memory(settings)
+    return {
+        'settings': settings,
+        'compressed_size': size,
+        'compression_time': elapsed,
+        'timed_alone': False,
+        'decoder_memory': memory,
+        'ok': size <= MAX_FIRMWARE_SIZE and memory <= MAX_DECODER_MEMORY,
+    }
+
+
+def time_finalists(tar_path, results):
+    """Time the fastest passing results again one at a time, so that their times can be compared."""
+    passing = sorted((result for result in results if result['ok']), key=lambda result: result['compression_time'])
+    for result in passing[:FINALISTS]:
+        times = [compress_candidate(tar_path, result['settings'])[1] for _ in range(TIMING_REPEATS)]
+        result['compression_time'] = min(times)
+        result['timed_alone'] = True
+
+
+def tune(tree_path, repacker, jobs=None, candidates=None):
+    """Try the candidate settings on an unpacked firmware in parallel and time the fastest ones one at a time.
+
+    Returns the results of every candidate sorted by compression time, fastest first. Only the times of the
+    results with timed_alone set can be compared to each other.
+    """
+    candidates = candidates or candidate_grid()
+    fd, tar_path = tempfile.mkstemp(suffix='.tar')
+    os.close(fd)
+    try:
+        # The candidates compress the same TAR that repack would write
+        with tarfile.open(tar_path, 'w', format=tarfile.GNU_FORMAT) as tar:
+            repacker.add_files_to_tar(tar, os.path.abspath(tree_path))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(try_candidate, [tar_path] * len(candidates), candidates))
+        time_finalists(tar_path, results)
+    finally:
+        os.remove(tar_path)
+    return sorted(results, key=lambda result: (not result['timed_alone'], result['compression_time'],
+                                               result['compressed_size']))
+
+
+def best_result(results):
+    """Return the fastest result that meets the limits, of the ones timed alone, or None if none of them do."""
+    passing = [result for result in results if result['ok'] and result['timed_alone']]
+    if not passing:
+        return None
+    return min(passing, key=lambda result: (result['compression_time'], result['compressed_size']))
+
+
+def profile_path(tree_path):
+    return os.path.normpath(os.path.abspath(tree_path)) + PROFILE_SUFFIX
+
+
+def save_profile(path, result):
+    profile = {
+        'filters': [result['settings']],
+        'compressed_size': result['compressed_size'],
+        'compression_time': result['compression_time'],
+        'decoder_memory': result['decoder_memory'],
+    }
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=4)
+
+
+def load_profile(path):
+    """Load LZMA filters from a profile saved by tune. Raises ValueError if they exceed the limits."""
+    with open(path) as f:
+        profile = json.load(f)
+    settings = profile['filters'][0]
+    if settings['dict_size'] > MAX_DICT_SIZE or decoder_memory(settings) > MAX_DECODER_MEMORY:
+        raise ValueError('LZMA profile needs too much memory to decompress on the OP-1: {}'.format(path))
+    return filters_from_settings(settings)
@@ -0,0 +1,73 @@
+"""Create workspaces of unpacked firmware that share their unchanged files with the base firmware.
+
+Every file in a workspace is a hardlink to the file in the unpacked base firmware, so creating one takes almost no
+space or time. Before a file is changed in place, unshare_file replaces it with a copy of its own, so the base and
+the other workspaces keep their files. The copies are reflinks that share the data until it's changed where the
+filesystem supports them (e.g. Btrfs and XFS on Linux).
+"""
+
+import os
+import sys
+import stat
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The ioctl request that clones a file on Linux, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+WORKSPACE_SUFFIX = '-workspace'
+
+
+def reflink(source, target):
+    """Clone source to target, sharing the data blocks. Returns False if the filesystem doesn't support it."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+    if not cloned:
+        os.remove(target)
+        return False
+    shutil.copystat(source, target)
+    return True
+
+
+def copy_file(source, target):
+    if not reflink(source, target):
+        shutil.copy2(source, target)
+
+
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # E.g. the workspace is on another filesystem
+        copy_file(source, target)
+
+
+def create_workspace(base_path, workspace_path):
+    """Create a workspace of the unpacked firmware at base_path. Raises FileExistsError if workspace_path exists."""
+    shutil.copytree(base_path, workspace_path, symlinks=True, copy_function=link_file)
+
+
+def unshare_file(path):
+    """Replace a file that has other hardlinks with a copy of its own, so it can be changed in place.
+
+    Returns True if the file was copied. Files without other links are left as they are.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2:
+        return False
+    temp_path = path + '.unsharing'
+    copy_file(path, temp_path)
+    os.replace(temp_path, path)
+    return True
@@ -26,6 +26,9 @@ setup(name="op1repacker",
       install_requires=[
           "svg.path",
       ],
+      extras_require={
+          "transform": ["numpy"],
+      },
       entry_points={
           "console_scripts": ["op1repacker=op1repacker.main:main"]
       },
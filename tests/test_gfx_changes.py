@@ -0,0 +1,156 @@
+"""The changes of GFX patches applied to parsed SVG documents give the same results as the regular expressions."""
+
+import os
+import json
+import random
+import unittest
+
+from op1repacker import op1_gfx
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DISPLAY_ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'op1repacker', 'assets',
+                              'display')
+TAGS = ['rect', 'line', 'circle', 'polyline', 'path']
+IDS = ['grid', 'cwo', 'loopin', 'track_x5F_active', 'ghost_x5F_line']
+# Matrices that keep rectangles upright and circles round, so every element can be transformed
+MATRICES = [[1, 0, 0, 1, 5, -3], [-1, 0, 0, 1, 320, 0], [1, 0, 0, -1, 0, 160], [0.5, 0, 0, 0.5, 1.5, 0]]
+
+
+def apply_change_by_change(data, changes):
+    """The results the changes must give, each applied with the regular expressions over the whole data."""
+    for change in changes:
+        data = op1_gfx.apply_change(data, change)
+    return data
+
+
+def load_bundled_patch(name):
+    with open(os.path.join(DISPLAY_ASSETS, name + op1_gfx.GFX_PATCH_SUFFIX)) as f:
+        return json.load(f)
+
+
+def element(rng, tag, svg_id=None):
+    x, y = rng.randrange(320), rng.randrange(160)
+    attributes = ' id="{}"'.format(svg_id) if svg_id else ''
+    if tag == 'rect':
+        return '<rect{} x="{}.25" y="{}.75" width="10" height="10" fill="#FFF"/>'.format(attributes, x, y)
+    if tag == 'line':
+        return '<line{} fill="none" stroke="#FFF" x1="{}" y1="{}" x2="{}" y2="{}"/>'.format(
+            attributes, x, y, x + 5, y + 5)
+    if tag == 'circle':
+        return '<circle{} fill="#FFF" cx="{}.5" cy="{}" r="2"/>'.format(attributes, x, y)
+    if tag == 'polyline':
+        return '<polyline{} fill="none" points="{},{} {},{} {},{}"/>'.format(
+            attributes, x, y, x + 1, y + 2, x + 3, y + 4)
+    return '<path{} fill="none" d="M{},{} C{},{} {},{} {},{} L{},{}"/>'.format(
+        attributes, x, y, x + 1, y + 1, x + 2, y + 3, x + 4, y + 4, x + 6, y)
+
+
+def generated_svg(rng, rows=40):
+    """Return SVG data with elements of every kind the changes move, some of them with ids and in groups."""
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<svg version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg" width="320px" height="160px">']
+    for _ in range(rows):
+        kind = rng.random()
+        if kind < 0.15:
+            svg_id = rng.choice(IDS)
+            lines.append('\t<g id="{}">'.format(svg_id))
+            lines.extend('\t\t' + element(rng, rng.choice(TAGS)) for _ in range(rng.randrange(1, 4)))
+            lines.append('\t</g>')
+        elif kind < 0.4:
+            lines.append('\t' + element(rng, rng.choice(TAGS), rng.choice(IDS)))
+        else:
+            lines.append('\t' + element(rng, rng.choice(TAGS)))
+    lines.append('</svg>')
+    return '\n'.join(lines) + '\n'
+
+
+def random_changes(rng):
+    changes = []
+    if rng.random() < 0.7:
+        # Most patches join the lines first, elements can't be moved over line breaks
+        changes.append({'type': 'substitute', 'find': '\n', 'replace': ' '})
+    for _ in range(rng.randrange(1, 5)):
+        kind = rng.randrange(5 if numpy is not None else 4)
+        delta = [rng.randrange(-50, 50), rng.choice([0, 0.5, -31, 147])]
+        elements = [[rng.choice(TAGS + ['g']), rng.choice(IDS)] for _ in range(rng.randrange(1, 4))]
+        if kind == 0:
+            changes.append({'type': 'move_all', 'delta': delta})
+        elif kind == 1:
+            changes.append({'type': 'move_element', 'tag': elements[0][0], 'id': elements[0][1], 'delta': delta})
+        elif kind == 2:
+            changes.append({'type': 'move_elements', 'elements': elements, 'delta': delta})
+        elif kind == 3:
+            changes.append({'type': 'substitute', 'find': '\t', 'replace': ' '})
+        else:
+            change = {'type': 'transform', 'matrix': rng.choice(MATRICES)}
+            if rng.random() < 0.5:
+                change['elements'] = elements
+            changes.append(change)
+    return changes
+
+
+class GfxChangesTest(unittest.TestCase):
+
+    def assertSameResult(self, data, changes):
+        expected = apply_change_by_change(data, changes)
+        self.assertEqual(op1_gfx.apply_changes(data, changes), expected)
+        return expected
+
+    def test_bundled_patches(self):
+        rng = random.Random(0)
+        tape_elements = load_bundled_patch('tape-invert')['changes'][-1]['elements']
+        tape_lines = ['<svg version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg">', '\t<g id="grid">']
+        tape_lines.extend('\t\t' + element(rng, rng.choice(TAGS)) for _ in range(4))
+        tape_lines.append('\t</g>')
+        tape_lines.extend('\t' + element(rng, tag, svg_id) for tag, svg_id in tape_elements if tag != 'g')
+        tape_lines.extend('\t' + element(rng, rng.choice(TAGS)) for _ in range(40))
+        tape = '\n'.join(tape_lines + ['</svg>']) + '\n'
+
+        bode_lines = ['<svg version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg">',
+                      '\t<path fill="#FFF" d="M91.087,37.5 c0.5,0.5 -0.898-0.627"/>',
+                      '\t<g id="cwo">', '\t\t<path fill="none" stroke="#FFF" d="M10,10 L20,20"/>', '\t</g>']
+        bode_lines.extend('\t' + element(rng, rng.choice(TAGS)) for _ in range(40))
+        bode = '\n'.join(bode_lines + ['</svg>']) + '\n'
+
+        for name, data in [('tape-invert', tape), ('cwo-moose', bode)]:
+            with self.subTest(patch=name):
+                self.assertIsNotNone(op1_gfx.SVGDocument.parse(data))
+                changes = load_bundled_patch(name)['changes']
+                self.assertNotEqual(self.assertSameResult(data, changes), data)
+
+    def test_generated_svgs(self):
+        rng = random.Random(1)
+        for seed in range(100):
+            data = generated_svg(rng)
+            changes = random_changes(rng)
+            with self.subTest(seed=seed, changes=changes):
+                self.assertIsNotNone(op1_gfx.SVGDocument.parse(data))
+                self.assertSameResult(data, changes)
+
+    def test_fallback(self):
+        rng = random.Random(2)
+        unsafe = [
+            "<rect x='1' y='2' width='3' height='4'/>",
+            '<!-- <line id="grid" x1="5" y1="5" x2="6" y2="6"/> -->',
+            '<text x="1" y="2">a < b</text>',
+            '<text x="1" y="2">x1="5"</text>',
+            '<rect width="3" height="4" x="1"/>',
+            '<line id="loopin" title="a > b" x1="5" y1="5" x2="6" y2="6"/>',
+        ]
+        for text in unsafe:
+            lines = generated_svg(rng, rows=10).split('\n')
+            lines.insert(3, '\t' + text)
+            data = '\n'.join(lines)
+            self.assertIsNone(op1_gfx.SVGDocument.parse(data), text)
+            for _ in range(10):
+                changes = random_changes(rng)
+                with self.subTest(text=text, changes=changes):
+                    self.assertSameResult(data, changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
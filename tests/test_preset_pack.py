@@ -0,0 +1,124 @@
+"""Adding preset packs to unpacked firmware with modify and to firmware files with patch."""
+
+import io
+import os
+import sys
+import json
+import sqlite3
+import tarfile
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+from op1repacker import main
+from op1repacker import op1_patches
+from op1repacker import op1_repack
+
+PACK_PRESETS = {
+    'pack/iter/bass.aif': {'type': 'iter', 'knobs': [1, 2, 3]},
+    'pack/dna/lead.aif': {'type': 'dna', 'knobs': [4, 5, 6]},
+}
+
+
+class PresetPackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = self.temp_dir.name
+        self.tree = os.path.join(self.path, 'op1_test')
+        os.makedirs(os.path.join(self.tree, 'content'))
+        db = sqlite3.connect(self.db_path(self.tree))
+        db.execute('CREATE TABLE synth_presets (id INTEGER PRIMARY KEY, patch TEXT, folder TEXT)')
+        db.execute('INSERT INTO synth_presets (patch, folder) VALUES (?, ?)',
+                   (json.dumps({'type': 'iter', 'name': 'factory'}), 'iter'))
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def db_path(self, tree):
+        return os.path.join(tree, 'content', 'op1_factory.db')
+
+    def presets(self, tree):
+        db = sqlite3.connect(self.db_path(tree))
+        try:
+            rows = db.execute('SELECT folder, patch FROM synth_presets').fetchall()
+        finally:
+            db.close()
+        return sorted((folder, json.loads(patch)['name']) for folder, patch in rows)
+
+    def write_zip_pack(self):
+        path = os.path.join(self.path, 'pack.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, patch in PACK_PRESETS.items():
+                archive.writestr(name, op1_patches.patch_to_aiff(patch))
+            archive.writestr('pack/readme.txt', 'not a preset')
+        return path
+
+    def write_tar_pack(self):
+        path = os.path.join(self.path, 'pack.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            for name, patch in PACK_PRESETS.items():
+                data = op1_patches.patch_to_aiff(patch)
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return path
+
+    def write_folder_pack(self):
+        path = os.path.join(self.path, 'pack-folder')
+        for name, patch in PACK_PRESETS.items():
+            # .aiff files count as presets too
+            patch_path = os.path.join(path, *name.split('/')) + 'f'
+            os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+            op1_patches.write_patch(patch_path, patch)
+        with open(os.path.join(path, 'pack', 'readme.txt'), 'w') as f:
+            f.write('not a preset')
+        return path
+
+    def run_main(self, *argv):
+        with mock.patch.object(sys, 'argv', ['op1repacker'] + list(argv)), redirect_stdout(io.StringIO()):
+            return main.main()
+
+    def test_modify_adds_zip_pack(self):
+        self.assertEqual(self.run_main('modify', self.tree, '--preset-pack', self.write_zip_pack()), 0)
+        expected = [('dna', 'lead'), ('iter', 'bass'), ('iter', 'factory')]
+        self.assertEqual(self.presets(self.tree), expected)
+
+        # Presets that are already in the database are skipped
+        self.assertEqual(self.run_main('modify', self.tree, '--preset-pack', self.write_zip_pack()), 0)
+        self.assertEqual(self.presets(self.tree), expected)
+
+    def test_patch_adds_tar_pack(self):
+        repacker = op1_repack.OP1Repack()
+        self.assertTrue(repacker.repack(self.tree))
+        firmware = self.tree + '-repacked.op1'
+        self.assertEqual(self.run_main('patch', firmware, '--preset-pack', self.write_tar_pack()), 0)
+
+        patched_tree = os.path.join(self.path, 'patched')
+        self.assertTrue(repacker.unpack(self.tree + '-repacked-repacked.op1', target_path=patched_tree))
+        self.assertEqual(self.presets(patched_tree), [('dna', 'lead'), ('iter', 'bass'), ('iter', 'factory')])
+
+    def test_modify_adds_folder_pack(self):
+        self.assertEqual(self.run_main('modify', self.tree, '--preset-pack', self.write_folder_pack()), 0)
+        self.assertEqual(self.presets(self.tree), [('dna', 'lead'), ('iter', 'bass'), ('iter', 'factory')])
+
+    def test_empty_pack(self):
+        path = os.path.join(self.path, 'empty')
+        os.makedirs(os.path.join(path, 'pack'))
+        self.assertEqual(self.run_main('modify', self.tree, '--preset-pack', path), 1)
+        self.assertEqual(self.presets(self.tree), [('iter', 'factory')])
+
+    def test_invalid_pack(self):
+        path = os.path.join(self.path, 'pack.txt')
+        with open(path, 'w') as f:
+            f.write('not an archive')
+        self.assertEqual(self.run_main('modify', self.tree, '--preset-pack', path), 1)
+        self.assertEqual(self.presets(self.tree), [('iter', 'factory')])
+
+
+if __name__ == '__main__':
+    unittest.main()